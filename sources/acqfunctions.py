@@ -1,6 +1,9 @@
 """ Functions used for running the acquisition of kinematics """
 
 import videotools as vt
+from catalog import get_catalog
+from vidindex import get_index
+import datastore as ds
 import os
 import pandas as pd
 import numpy as np
@@ -20,24 +23,8 @@ def get_cat_info(cat_path, include_mode='both'):
 
     """
 
-    # Open CSV file
-    file = open(cat_path)
-
-    # Import CSV data
-    d = pd.read_csv(file)
-
-    # Determine which rows to include
-    if include_mode=='both':
-        d = d.loc[(d.analyze == 1) & (d.make_video == 1)]
-
-    elif include_mode=='analyze':
-        d = d.loc[(d.analyze == 1)]
-        
-    elif include_mode=='make_video':
-        d = d.loc[(d.make_video == 1)]
-
-    # Reset indices for the new rows
-    d = d.reset_index(drop=True)
+    # Parse catalog (cached until the file changes) and select rows
+    d = get_catalog(cat_path).select(include_mode)
 
     return d
 
@@ -97,7 +84,7 @@ def make_videos(df, im_path, vid_path, vmode=False, vertpix=None, suffix_in='JPG
 
 def convert_videos(df, in_path, out_path, out_name=None, in_name=None,  
     vmode=True, vertpix=None, imquality=1, suffix_in='MOV', suffix_out='mp4', 
-    para_mode=False, echo=True, border_pix=None):
+    para_mode=False, echo=True, border_pix=None, maskpath=None, segments=None, gop=None):
     """ Uses videotools to convert videos from experiments
 
     df: dataframe generated by get_cat_info with the info needed for each video where analyze==1 and make_video==1.
@@ -109,15 +96,23 @@ def convert_videos(df, in_path, out_path, out_name=None, in_name=None,
     imquality: Image quality (low to high: 0 to 1) for output video
     suffix_in: Suffix for source images or movies
     suffix_out: Suffix for output movies
-    vertpix: Size of video frames in vertical pixels 
+    vertpix: Size of video frames in vertical pixels (currently not applied: videos are cropped at full resolution)
     para_mode: Whether to run parallel processing (requires additional code)
     echo: Whether to print the steps as they are executed
     pix_extra: Number of pixels to include around the roi
+    maskpath: Directory path for the mask image files (df.mask_filename). If given, each video is masked and cropped 
+    in a single pass, from the raw video.
+    segments: Number of segments of each video to encode in parallel (see videotools.vid_convert_segmented). 
+    Not used with para_mode.
+    gop: Max number of frames between keyframes in the output videos (1 for all-intra, e.g. for labeling)
     """
 
+    if para_mode and (segments is not None):
+        raise ValueError('segments cannot be used with para_mode')
+
     if para_mode:
-        # Set up empty dataframe for parallel processing of ffmpeg commands
-        cmds = pd.DataFrame(columns=['command'])
+        # Set up list of ffmpeg commands for parallel processing
+        cmd_list = []
 
     # Loop thru each video listed in df
     for c_row in df.index:
@@ -140,7 +135,8 @@ def convert_videos(df, in_path, out_path, out_name=None, in_name=None,
         else:
             r = None
 
-        # Overwrite vertpix
+        # Overwrite vertpix, to keep the cropped frames at full resolution (vertPix scales the roi itself, 
+        # which would enlarge rois smaller than vertpix)
         vertpix=None
 
         # filename via date_trial system
@@ -185,6 +181,16 @@ def convert_videos(df, in_path, out_path, out_name=None, in_name=None,
         #     tot_out_path = out_path + os.sep + df.video_filename[c_row] + '.' + suffix_out
         #     # tot_out_path = out_path + os.sep + os.path.splitext(os.path.basename(in_path))[0] + '.' + suffix_out
 
+        # Total mask path 
+        if maskpath is not None:
+            tot_mask_path = maskpath + os.sep + df.mask_filename[c_row] + '.png'
+
+            # Check for mask path
+            if not os.path.isfile(tot_mask_path):
+                raise OSError('Mask file does not exist: ' + tot_mask_path)
+        else:
+            tot_mask_path = None
+
         # Check for source video
         if not os.path.isfile(tot_in_path):
             raise OSError('Video file does not exist: ' + tot_in_path)
@@ -198,15 +204,16 @@ def convert_videos(df, in_path, out_path, out_name=None, in_name=None,
             print('Converting video ' + str(c_row+1) + ' of ' + str(len(df)))
 
         # Create movie
-        cmd = vt.vid_convert(tot_in_path, tot_out_path, imQuality=imquality, vertPix=vertpix,
-                       roi=r, vMode=vmode, para_mode=para_mode, echo=echo)
+        if segments is not None:
+            cmd = vt.vid_convert_segmented(tot_in_path, tot_out_path, n_segments=segments, imQuality=imquality, 
+                       vertPix=vertpix, roi=r, vMode=vmode, maskpath=tot_mask_path, echo=echo, gop=gop)
+        else:
+            cmd = vt.vid_convert(tot_in_path, tot_out_path, imQuality=imquality, vertPix=vertpix,
+                       roi=r, vMode=vmode, maskpath=tot_mask_path, para_mode=para_mode, echo=echo, gop=gop)
 
         if para_mode:
-            cmds_c = pd.DataFrame([[cmd]],
-                                columns=['command'])
-
-            # Add to dataframe
-            cmds = pd.concat([cmds, cmds_c], sort=False, ignore_index=True)
+            # Add to list
+            cmd_list.append(cmd)
 
         else:
             cmds = cmd
@@ -215,6 +222,10 @@ def convert_videos(df, in_path, out_path, out_name=None, in_name=None,
         if echo:
             print('Finished with ' + str(c_row + 1) + ' of ' + str(len(df)) + ' videos.')
 
+    # Dataframe of commands for parallel processing
+    if para_mode:
+        cmds = pd.DataFrame({'command': cmd_list})
+
     return cmds
 
 def convert_masked_videos(df, in_path, out_path, maskpath, in_name=None,
@@ -237,8 +248,8 @@ def convert_masked_videos(df, in_path, out_path, maskpath, in_name=None,
     """
     
     if para_mode:
-        # Set up empty dataframe for parallel processing of ffmpeg commands
-        cmds = pd.DataFrame(columns=['command'])
+        # Set up list of ffmpeg commands for parallel processing
+        cmd_list = []
 
     # Loop thru each video listed in df
     for c_row in df.index:
@@ -293,11 +304,8 @@ def convert_masked_videos(df, in_path, out_path, maskpath, in_name=None,
                              maskpath=tot_mask_path, para_mode=para_mode, echo=echo)
 
         if para_mode:
-            cmds_c = pd.DataFrame([[cmd]],
-                                columns=['command'])
-
-            # Add to dataframe
-            cmds = pd.concat([cmds, cmds_c], sort=False, ignore_index=True)
+            # Add to list
+            cmd_list.append(cmd)
         else:
             cmds = cmd
 
@@ -305,63 +313,240 @@ def convert_masked_videos(df, in_path, out_path, maskpath, in_name=None,
             # Report counter
             print('Finished with ' + str(c_row + 1) + ' of ' + str(len(df)) + ' videos.')
 
+    # Dataframe of commands for parallel processing
+    if para_mode:
+        cmds = pd.DataFrame({'command': cmd_list})
+
     return cmds
-    # Execute ffmpeg using the parallel processing
-    # if parallel_mode:
 
-    #     import time
-    #     import ipyparallel as ipp
-    #     import sys
 
-    #     # Report python and IPyparallel versions to make sure they exist
-    #     # print("Python Version : ", sys.version)
-    #     # print("IPyparallel Version : ", ipp.__version__)
+def survey_videos(df, in_path, out_path, suffix_in='MOV', suffix_out='mp4', workers=None, echo=True):
+    """ Checks the converted videos against their sources, from the video metadata index (see vidindex).
+    Videos missing from the index are probed in parallel. Returns a dataframe with one row per video in df, 
+    with the reason for each video that is not ok under 'message'.
 
-    #     # Set up clients 
-    #     client = ipp.Client()
-    #     type(client), client.ids
+    df: dataframe generated by get_cat_info
+    in_path: Path to directory of input videos (with a subdirectory for each date)
+    out_path: Path to directory of output videos
+    suffix_in: Suffix for source movies
+    suffix_out: Suffix for output movies
+    workers: Number of videos probed at once (defaults to the number of cores)
+    echo: Whether to report each video that was not made correctly
+    """
 
-    #     # Direct view allows shared data (balanced_view is the alternative)
-    #     direct_view = client[:]
+    index = get_index()
+
+    in_paths  = [in_path + os.sep + df.date[c] + os.sep + df.video_filename[c] + '.' + suffix_in for c in df.index]
+    out_paths = [out_path + os.sep + df.video_filename[c] + '.' + suffix_out for c in df.index]
+
+    # Metadata of the videos that exist
+    in_found  = [p for p in in_paths if os.path.isfile(p)]
+    out_found = [p for p in out_paths if os.path.isfile(p)]
+    # (videos that cannot be read have no frame count, and the reason under 'error')
+    info = index.probe_all(in_found + out_found, workers=workers, packets=True)
+    frames = dict(zip(in_found + out_found, info.frame_count.astype('float')))
+    errors = dict(zip(in_found + out_found, info.error))
+
+    survey = pd.DataFrame({'in_path':       in_paths,
+                           'out_path':      out_paths,
+                           'in_frames':     [frames.get(p, np.nan) for p in in_paths],
+                           'out_frames':    [frames.get(p, np.nan) for p in out_paths]})
+    survey['ok'] = survey.out_frames.notna() & (survey.out_frames == survey.in_frames)
+
+    # Reason for each video that is not ok
+    messages = []
+    for c_in, c_out, c_ok in zip(in_paths, out_paths, survey.ok):
+        if c_ok:
+            messages.append('')
+        elif c_out not in frames:
+            messages.append('Output movie NOT created')
+        elif errors.get(c_out) is not None:
+            messages.append('Output movie cannot be read (' + errors[c_out] + ')')
+        elif c_in not in frames:
+            messages.append('Source movie not found')
+        elif errors.get(c_in) is not None:
+            messages.append('Source movie cannot be read (' + errors[c_in] + ')')
+        else:
+            messages.append('Output movie has ' + format(frames[c_out], '.0f') + ' frames, source has ' + 
+                            format(frames[c_in], '.0f'))
+    survey['message'] = messages
+
+    if echo:
+        for c_row in survey.index[~survey.ok]:
+            print('   ' + survey.message[c_row] + ': ' + survey.out_path[c_row])
+        print('   ' + str(survey.ok.sum()) + ' of ' + str(len(survey)) + ' movies created successfully')
+
+    return survey
+
+
+def make_backgrounds(df, in_path, out_path, max_frames=100, method='median', suffix_in='mp4', workers=None, 
+                     echo=True, cached=False):
+    """ Estimates the background of each video in df (headless, see videotools.get_background), in parallel.
+    Writes one PNG per video, named after the video. Returns a dataframe of the video and background paths.
+
+    df: dataframe generated by get_cat_info
+    in_path: Path to directory of videos (e.g., the converted videos)
+    out_path: Path to directory for the background images
+    max_frames: Number of frames sampled across each video
+    method: How the sampled frames are combined: 'median' or 'trimmed_mean'
+    suffix_in: Suffix for the movies
+    workers: Number of videos processed at once (defaults to the number of cores)
+    echo: Whether to report each background image as it is made
+    cached: Whether to decode each video into the frame cache, for reuse by later steps (see videotools.get_background)
+    """
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Check for output directory
+    if not os.path.isdir(out_path):
+        raise OSError('Output directory does not exist: ' + out_path)
+
+    vid_paths = [in_path + os.sep + df.video_filename[c] + '.' + suffix_in for c in df.index]
+    bg_paths  = [out_path + os.sep + df.video_filename[c] + '.png' for c in df.index]
+
+    # Check for source videos
+    for c_path in vid_paths:
+        if not os.path.isfile(c_path):
+            raise OSError('Video file does not exist: ' + c_path)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(vt.get_background, v, b, max_frames, headless=True, method=method,
+                               cached=cached) for v, b in zip(vid_paths, bg_paths)]
+
+        for c_path, future in zip(bg_paths, futures):
+            future.result()
+            if echo:
+                print('   Background image complete: ' + c_path)
+
+    return pd.DataFrame({'vid_path': vid_paths, 'bg_path': bg_paths})
+
+
+def measure_frame_stats(df, in_path, out_path, rois=None, hist_bins=0, step=1, scale=None, fmt='parquet', 
+                        suffix_in='mp4', workers=None, echo=True, cached=False):
+    """ Measures per-frame statistics (mean intensity, roi means, motion energy and histograms) of each video 
+    in df, in parallel (see videotools.frame_stats). Writes one table per video, named after the video 
+    with '_framestats'. Returns a dataframe of the video and table paths.
+
+    df: dataframe generated by get_cat_info
+    in_path: Path to directory of videos (e.g., the converted videos)
+    out_path: Path to directory for the tables
+    rois: Dict of regions of interest (name: [x y w h], in pixels), used for every video
+    hist_bins: Number of bins of the intensity histogram (no histogram, if 0)
+    step: Measure every step-th frame
+    scale: Factor for the frame size, applied as each video is decoded (full size, if None)
+    fmt: Storage format of the tables (see datastore)
+    suffix_in: Suffix for the movies
+    workers: Number of videos processed at once (defaults to the number of cores)
+    echo: Whether to report each table as it is written
+    cached: Whether to read the frames from the frame cache (see videotools.frame_stats)
+    """
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Check for output directory
+    if not os.path.isdir(out_path):
+        raise OSError('Output directory does not exist: ' + out_path)
+
+    vid_paths  = [in_path + os.sep + df.video_filename[c] + '.' + suffix_in for c in df.index]
+    base_paths = [out_path + os.sep + df.video_filename[c] + '_framestats' for c in df.index]
+
+    # Check for source videos
+    for c_path in vid_paths:
+        if not os.path.isfile(c_path):
+            raise OSError('Video file does not exist: ' + c_path)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(vt.frame_stats, v, rois=rois, hist_bins=hist_bins, step=step, scale=scale, 
+                               out_path=b, fmt=fmt, cached=cached) for v, b in zip(vid_paths, base_paths)]
+
+        for c_path, future in zip(base_paths, futures):
+            future.result()
+            if echo:
+                print('   Frame statistics complete: ' + c_path)
 
-    #     # Function to execute the code
-    #     def slow_power(idx):
-    #         import os
-    #         os.system(cmds_run.command[idx])
-    #         return idx
+    return pd.DataFrame({'vid_path': vid_paths, 'data_path': [b + ds.format_ext(fmt) for b in base_paths]})
 
-    #     direct_view["cmds_run"] = cmds
 
-    #     res = []
-    #     for n in range(len(direct_view)):
-    #         res.append(client[n].apply(slow_power, n))
+def run_commands(cmds, n_jobs=None, mode='thread', log_path=None, retries=0, echo=True):
+    """ Runs a table of command-line instructions (e.g., ffmpeg commands from convert_videos with 
+    para_mode=True) in parallel on the local machine.
 
-    #     [r.result() for r in res]
+    cmds: dataframe with a 'command' column (or a list of commands)
+    n_jobs: Number of jobs run at once (defaults to the number of CPU cores)
+    mode: 'thread' or 'process' pool. Threads suffice when each command runs in its own process (e.g., ffmpeg)
+    log_path: Directory for the log of each job (defaults to a new temporary directory)
+    retries: Number of times a failed command is rerun
+    echo: Whether to print the status of each job as it finishes
 
-# def batch_command(cmds):
-#     # import time
-#     import ipyparallel as ipp
-#     import sys
+    Returns a dataframe with the command, exit code, wall time (s), number of attempts and log file of each job.
+    """
+
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+    # List of commands
+    if isinstance(cmds, pd.DataFrame):
+        cmd_list = list(cmds.command)
+    else:
+        cmd_list = list(cmds)
+
+    # Directory for logs
+    if log_path is None:
+        log_path = tempfile.mkdtemp(prefix='kinekit_logs_')
+    elif not os.path.isdir(log_path):
+        raise OSError('Log directory does not exist: ' + log_path)
+
+    if mode=='thread':
+        pool_type = ThreadPoolExecutor
+    elif mode=='process':
+        pool_type = ProcessPoolExecutor
+    else:
+        raise ValueError('mode not recognized: ' + str(mode))
 
-#     # Report python and IPyparallel versions to make sure they exist
-#     # print("Python Version : ", sys.version)
-#     # print("IPyparallel Version : ", ipp.__version__)
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
 
-#     # Set up clients 
-#     client = ipp.Client()
-#     type(client), client.ids
+    results = [None]*len(cmd_list)
+    with pool_type(max_workers=n_jobs) as pool:
+        futures = {}
+        for idx, cmd in enumerate(cmd_list):
+            log_file = log_path + os.sep + 'job_' + format(idx,'04') + '.log'
+            futures[pool.submit(run_command_job, cmd, log_file, retries)] = idx
 
-#     # Direct view allows shared data (balanced_view is the alternative)
-#     direct_view = client[:]
+        # Collect each job as it finishes
+        for c_future in as_completed(futures):
+            idx = futures[c_future]
+            results[idx] = c_future.result()
 
-#     # Function to execute the code
-#     def run_command(idx):
-#         import os
-#         os.system(cmds_run.command[idx])
-#         return idx
+            if echo:
+                status = 'done' if results[idx]['exit_code']==0 else 'FAILED (exit code ' + str(results[idx]['exit_code']) + ')'
+                print('Job ' + str(idx+1) + ' of ' + str(len(cmd_list)) + ' ' + status + 
+                      ' in ' + format(results[idx]['time_s'],'.1f') + ' s')
 
-#     direct_view["cmds_run"] = cmds
+    return pd.DataFrame(results, columns=['command','exit_code','time_s','attempts','log_file'])
+
+
+def run_command_job(cmd, log_file, retries=0):
+    """ Runs a single command-line instruction for run_commands, writing its output to log_file.
+    A failed command is rerun up to 'retries' times.
+
+    Returns a dict with the command, exit code, wall time (s), number of attempts and log file.
+    """
 
-#     res = []
-#     for n in range(len(direct_view)):
-#         res.append(client[n].apply(run_command, n))
\ No newline at end of file
+    import subprocess
+    import time
+
+    t_start = time.perf_counter()
+    with open(log_file, 'w') as log:
+        for attempt in range(1, retries+2):
+            log.write('# Attempt ' + str(attempt) + ': ' + cmd + '\n')
+            log.flush()
+            exit_code = subprocess.run(cmd, shell=True, stdout=log, stderr=subprocess.STDOUT).returncode
+            if exit_code==0:
+                break
+
+    return {'command':   cmd, 
+            'exit_code': exit_code, 
+            'time_s':    time.perf_counter()-t_start, 
+            'attempts':  attempt, 
+            'log_file':  log_file}
@@ -0,0 +1,133 @@
+""" Experiment catalog, shared by acqfunctions and procfunctions.
+The catalog CSV is parsed once and indexed by date and trial number (and schedule number, if present).
+It is reloaded only when the file's modification time changes.
+"""
+
+import os
+import pandas as pd
+import numpy as np
+
+
+# Catalogs already loaded, keyed by absolute path
+loaded_catalogs = {}
+
+
+def get_catalog(cat_path):
+    """ Returns the catalog for cat_path, parsing the CSV only on the first call or after it changes.
+
+    cat_path:   Full path to video catalog (CSV file)
+    """
+
+    key = os.path.abspath(cat_path)
+
+    if key not in loaded_catalogs:
+        loaded_catalogs[key] = Catalog(key)
+
+    cat = loaded_catalogs[key]
+    cat.refresh()
+
+    return cat
+
+
+class Catalog:
+    """ Experiment catalog with a hash index on (date, trial_num) and (date, sch_num, trial_num).
+
+    cat_path:   Full path to video catalog (CSV file)
+    """
+
+    def __init__(self, cat_path):
+        self.cat_path = cat_path
+        self.mtime    = None
+        self.data     = None
+        self.refresh()
+
+    def refresh(self):
+        """ Reloads the catalog, if the file has changed since it was last read """
+
+        mtime = os.path.getmtime(self.cat_path)
+        if mtime != self.mtime:
+            self.data  = pd.read_csv(self.cat_path)
+            self.mtime = mtime
+            self.build_index()
+
+    def build_index(self):
+        """ Builds the lookup tables from the rows that have a date and trial number, up to the first row 
+        without a date (rows below it are not experiments) """
+
+        self.index     = {}
+        self.sch_index = {}
+
+        d = self.data
+        valid = d.date.notna() & d.trial_num.notna()
+
+        # Rows with useful data end at the first blank date
+        blank = np.flatnonzero(d.date.isna().to_numpy())
+        if len(blank) > 0:
+            valid &= np.arange(len(d)) < blank[0]
+        has_sch = 'sch_num' in d.columns
+
+        for row in d.index[valid]:
+            date  = str(d.date[row])
+            trial = int(d.trial_num[row])
+            self.index.setdefault((date, trial), []).append(row)
+
+            if has_sch and pd.notna(d.sch_num[row]):
+                self.sch_index.setdefault((date, int(d.sch_num[row]), trial), []).append(row)
+
+    def find_row(self, date, trial_num, sch_num=None):
+        """ Returns the row label of the catalog that matches the sequence
+
+        date:       Date of experiment (e.g., '2022-10-01')
+        trial_num:  Trial number of experiment
+        sch_num:    Schedule number of experiment (optional)
+        """
+
+        self.refresh()
+
+        if sch_num is None:
+            rows = self.index.get((str(date), int(trial_num)), [])
+        else:
+            rows = self.sch_index.get((str(date), int(sch_num), int(trial_num)), [])
+
+        # Check that only one match found in catalog spreadsheet
+        if len(rows)<1:
+            raise ValueError('No matching sequence found in video_catalog')
+        elif len(rows)>1:
+            raise ValueError('More than one matching sequence found in video_catalog')
+
+        return rows[0]
+
+    def get_row(self, date, trial_num, sch_num=None):
+        """ Returns the row of the catalog (as a series) that matches the sequence """
+
+        return self.data.loc[self.find_row(date, trial_num, sch_num)]
+
+    def get_value(self, date, trial_num, col_name, sch_num=None):
+        """ Returns the value in column col_name for the matching sequence """
+
+        if col_name not in self.data.columns:
+            raise ValueError('Column not found in video_catalog: ' + col_name)
+
+        return self.data.at[self.find_row(date, trial_num, sch_num), col_name]
+
+    def select(self, include_mode='both'):
+        """ Returns a copy of the catalog rows to include, with reset indices.
+
+        include_mode: Criteria for what to include. Can be 'analyze', 'make_video', or 'both'
+        """
+
+        self.refresh()
+        d = self.data
+
+        # Determine which rows to include
+        if include_mode=='both':
+            d = d.loc[(d.analyze == 1) & (d.make_video == 1)]
+
+        elif include_mode=='analyze':
+            d = d.loc[(d.analyze == 1)]
+
+        elif include_mode=='make_video':
+            d = d.loc[(d.make_video == 1)]
+
+        # Reset indices for the new rows
+        return d.reset_index(drop=True)
@@ -0,0 +1,180 @@
+""" Storage of refined and derived data tables.
+Supports the legacy xz-compressed pickle ('pkl.xz') and two columnar formats from pyarrow:
+'parquet' and 'feather' (Arrow IPC). The columnar formats allow loading a subset of columns,
+and feather files that are saved uncompressed can be memory-mapped.
+Each output can be stamped with a hash of its input and its parameters, so that unchanged outputs are skipped on reruns.
+"""
+
+import os
+import pandas as pd
+
+
+# File extension and default compression for each format
+STORE_FORMATS = {
+    'pkl.xz':  {'ext': '.pkl.xz',  'compression': 'xz'},
+    'parquet': {'ext': '.parquet', 'compression': 'zstd'},
+    'feather': {'ext': '.feather', 'compression': 'lz4'},
+    }
+
+
+def check_format(fmt):
+    """ Raises an error if fmt is not a supported storage format """
+
+    if fmt not in STORE_FORMATS:
+        raise ValueError('Storage format not recognized: ' + str(fmt) +
+                         ' (use one of: ' + ', '.join(STORE_FORMATS) + ')')
+
+
+def format_ext(fmt):
+    """ Returns the file extension for storage format fmt (e.g., '.parquet') """
+
+    check_format(fmt)
+
+    return STORE_FORMATS[fmt]['ext']
+
+
+def path_format(path):
+    """ Returns the storage format of a data file, from its extension """
+
+    for fmt, c_info in STORE_FORMATS.items():
+        if path.endswith(c_info['ext']):
+            return fmt
+
+    raise ValueError('Data file format not recognized: ' + path)
+
+
+def save_data(df, base_path, fmt='pkl.xz', compression=None):
+    """ Saves a dataframe to disk in the requested format and returns the full path.
+
+    df:             Dataframe to be saved
+    base_path:      Path of the output file, without extension
+    fmt:            Storage format: 'pkl.xz', 'parquet' or 'feather'
+    compression:    Codec for the columnar formats (e.g., 'zstd', 'lz4', 'uncompressed'). Defaults per format.
+    """
+
+    out_path = base_path + format_ext(fmt)
+
+    if compression is None:
+        compression = STORE_FORMATS[fmt]['compression']
+
+    if fmt=='pkl.xz':
+        df.to_pickle(out_path, compression='xz')
+
+    else:
+        import pyarrow as pa
+
+        # Index is kept as columns, with pandas metadata to restore it
+        table = pa.Table.from_pandas(df)
+
+        if fmt=='parquet':
+            import pyarrow.parquet as pq
+            pq.write_table(table, out_path,
+                           compression='none' if compression=='uncompressed' else compression)
+
+        elif fmt=='feather':
+            import pyarrow.feather as pf
+            pf.write_feather(table, out_path, compression=compression)
+
+    return out_path
+
+
+def load_data(path, columns=None, memory_map=False):
+    """ Loads a dataframe saved by save_data. The format is taken from the file extension.
+
+    path:       Path to data file
+    columns:    List of columns to load (all, if None). Index columns are always loaded.
+    memory_map: Whether to memory-map the file (columnar formats only)
+    """
+
+    fmt = path_format(path)
+
+    if fmt=='pkl.xz':
+        df = pd.read_pickle(path, compression='xz')
+        if columns is not None:
+            df = df[list(columns)]
+        return df
+
+    if fmt=='parquet':
+        import pyarrow.parquet as pq
+        table = pq.read_table(path, columns=columns, memory_map=memory_map,
+                              use_pandas_metadata=True)
+
+    elif fmt=='feather':
+        import pyarrow.feather as pf
+
+        # Add the index columns to those requested
+        if columns is not None:
+            columns = list(columns) + [c for c in index_columns(path) if c not in columns]
+
+        table = pf.read_table(path, columns=columns, memory_map=memory_map)
+
+    return table.to_pandas()
+
+
+def index_columns(path):
+    """ Returns the names of the stored index columns of a feather data file """
+
+    import pyarrow.ipc as ipc
+
+    with ipc.open_file(path) as reader:
+        meta = reader.schema.pandas_metadata
+
+    if meta is None:
+        return []
+
+    # Range indices are stored as metadata only
+    return [c for c in meta['index_columns'] if isinstance(c, str)]
+
+
+def file_hash(path, chunk_size=2**20):
+    """ Returns the SHA-256 hash of the contents of a file """
+
+    import hashlib
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def input_stamp(in_path, params):
+    """ Returns a stamp of the input file and parameters that an output is made from.
+
+    in_path:    Path to the input file
+    params:     Dict of parameter values used to make the output (JSON-compatible)
+    """
+
+    return {'input':      in_path,
+            'input_hash': file_hash(in_path),
+            'params':     params}
+
+
+def stamp_path(out_path):
+    """ Returns the path of the stamp file kept next to an output file """
+
+    return out_path + '.json'
+
+
+def stamp_current(out_path, stamp):
+    """ Returns True if out_path exists and was made from the same input contents and parameters as stamp """
+
+    import json
+
+    if not (os.path.isfile(out_path) and os.path.isfile(stamp_path(out_path))):
+        return False
+
+    with open(stamp_path(out_path)) as f:
+        old = json.load(f)
+
+    return (old.get('input_hash') == stamp['input_hash']) and (old.get('params') == stamp['params'])
+
+
+def write_stamp(out_path, stamp):
+    """ Writes the stamp of an output file next to it """
+
+    import json
+
+    with open(stamp_path(out_path), 'w') as f:
+        json.dump(stamp, f, indent=2)
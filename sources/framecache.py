@@ -0,0 +1,272 @@
+""" Cache of decoded video frames, shared by the frame readers of videotools.
+A video is decoded once (as is, in grayscale and/or downsampled) into a raw uint8 file on local scratch disk.
+Later reads memory-map that file, so each frame is a slice of the mapped array rather than a new decode.
+Entries are checked against the size and modification time of the source video, and the least recently used
+entries are removed to keep the cache within its size budget.
+"""
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import numpy as np
+import cv2 as cv
+from vidindex import video_info
+
+
+# Default location of the cache (can be set with the KINEKIT_FRAME_CACHE environment variable)
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'kinekit_frame_cache')
+
+# Default size budget of the cache, in bytes (can be set with the KINEKIT_FRAME_CACHE_BYTES environment variable)
+DEFAULT_CACHE_BYTES = 2**34
+
+# Caches already opened, keyed by absolute path
+loaded_caches = {}
+
+
+def get_cache(cache_dir=None, max_bytes=None):
+    """ Returns the frame cache stored in cache_dir.
+
+    cache_dir:  Path to cache directory (defaults to KINEKIT_FRAME_CACHE, or DEFAULT_CACHE_DIR)
+    max_bytes:  Size budget of the cache, in bytes (when first opened, defaults to KINEKIT_FRAME_CACHE_BYTES,
+                or DEFAULT_CACHE_BYTES)
+    """
+
+    if cache_dir is None:
+        cache_dir = os.environ.get('KINEKIT_FRAME_CACHE', DEFAULT_CACHE_DIR)
+
+    key = os.path.abspath(cache_dir)
+
+    if key not in loaded_caches:
+        loaded_caches[key] = FrameCache(key, int(os.environ.get('KINEKIT_FRAME_CACHE_BYTES', DEFAULT_CACHE_BYTES)))
+
+    # A budget that is given replaces the current one
+    cache = loaded_caches[key]
+    if max_bytes is not None:
+        cache.max_bytes = max_bytes
+
+    return cache
+
+
+def cached_frames(vid_path, gray=False, scale=None, cache_dir=None):
+    """ Returns the frames of a video as a read-only array (frames, rows, columns[, channels]), mapped from the
+    cache, decoding the video only if it is not already cached (see FrameCache.get).
+
+    vid_path:   Full path to the video file
+    gray:       Whether the frames are in grayscale, rather than BGR
+    scale:      Factor for the frame size (e.g., 0.25; full size, if None)
+    cache_dir:  Path to cache directory (see get_cache)
+    """
+
+    return get_cache(cache_dir).get(vid_path, gray=gray, scale=scale)
+
+
+def convert_frame(frame, gray=False, size=None):
+    """ Returns a decoded (BGR) frame in grayscale and/or at another size, as stored in the cache.
+
+    frame:  Video frame, as read by OpenCV
+    gray:   Whether to convert the frame to grayscale
+    size:   Frame size (width, height) to resize to, by pixel area (unchanged, if None)
+    """
+
+    if gray and (frame.ndim == 3):
+        frame = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+
+    if (size is not None) and ((frame.shape[1], frame.shape[0]) != tuple(size)):
+        frame = cv.resize(frame, tuple(size), interpolation=cv.INTER_AREA)
+
+    return frame
+
+
+def frame_size_scaled(info, scale):
+    """ Returns the frame size (width, height) of a video after scaling by a factor """
+
+    return max(1, int(round(info['width'] * scale))), max(1, int(round(info['height'] * scale)))
+
+
+class FrameCache:
+    """ Decoded frames of videos, stored as raw uint8 files in a directory, with one file per video and format.
+    Each data file ('.u8') has a metadata file ('.json') with its source video, array shape and last use.
+
+    cache_dir:  Path to cache directory (created if needed)
+    max_bytes:  Size budget of the cache, in bytes
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_path(self, vid_path, gray=False, scale=None):
+        """ Returns the path of the cache entry of a video, without extension """
+
+        vid_path = os.path.abspath(vid_path)
+        name = os.path.splitext(os.path.basename(vid_path))[0]
+        name += '-' + hashlib.sha1(vid_path.encode()).hexdigest()[:12]
+        if gray:
+            name += '-gray'
+        if scale is not None:
+            name += '-x' + format(scale, 'g')
+
+        return os.path.join(self.cache_dir, name)
+
+    def lookup(self, vid_path, gray=False, scale=None):
+        """ Returns the cached frames of a video (read-only array), or None if they are missing or out of date """
+
+        base = self.entry_path(vid_path, gray, scale)
+        meta = read_meta(base + '.json')
+        if meta is None:
+            return None
+
+        # Source video changed since it was cached, or data file incomplete
+        stat = os.stat(vid_path)
+        if ((meta['size'] != stat.st_size) or (meta['mtime'] != stat.st_mtime) or
+                not os.path.isfile(base + '.u8') or (os.path.getsize(base + '.u8') != meta['bytes'])):
+            self.remove(base)
+            return None
+
+        # Record the use, for eviction
+        meta['used'] = time.time()
+        write_meta(base + '.json', meta)
+
+        if meta['bytes'] == 0:
+            return np.empty(meta['shape'], dtype='uint8')
+
+        return np.asarray(np.memmap(base + '.u8', dtype='uint8', mode='r', shape=tuple(meta['shape'])))
+
+    def build(self, vid_path, gray=False, scale=None):
+        """ Decodes a video into the cache, making room for it by removing the least recently used entries """
+
+        info = video_info(vid_path, packets=True)
+        base = self.entry_path(vid_path, gray, scale)
+        stat = os.stat(vid_path)
+
+        # Shape of the stored frames
+        width, height = (info['width'], info['height']) if scale is None else frame_size_scaled(info, scale)
+        frame_shape = (height, width) if gray else (height, width, 3)
+        frame_bytes = int(np.prod(frame_shape))
+        n_bytes = info['frame_count'] * frame_bytes
+
+        if n_bytes > self.max_bytes:
+            raise ValueError('Video does not fit in the frame cache (' + format(n_bytes / 2**30, '.1f') +
+                             ' GB): ' + vid_path)
+
+        self.evict(n_bytes)
+
+        # Decode into a temporary file, which is moved into place once complete
+        tmp_path = base + '.' + str(os.getpid()) + '.tmp'
+        cap = cv.VideoCapture(vid_path)
+        if not cap.isOpened():
+            raise OSError('Video cannot be read: ' + vid_path)
+
+        n_frames = 0
+        try:
+            if n_bytes > 0:
+                data = np.memmap(tmp_path, dtype='uint8', mode='w+', shape=(info['frame_count'],) + frame_shape)
+                while n_frames < info['frame_count']:
+                    ret, frame = cap.read()
+                    if not ret:
+                        break
+                    data[n_frames] = convert_frame(frame, gray, (width, height))
+                    n_frames += 1
+                data.flush()
+                del data
+
+                # Drop the frames that could not be decoded
+                os.truncate(tmp_path, n_frames * frame_bytes)
+            else:
+                open(tmp_path, 'wb').close()
+
+            os.replace(tmp_path, base + '.u8')
+
+        finally:
+            cap.release()
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+
+        write_meta(base + '.json', {'path':    os.path.abspath(vid_path),
+                                    'size':    stat.st_size,
+                                    'mtime':   stat.st_mtime,
+                                    'gray':    bool(gray),
+                                    'scale':   scale,
+                                    'shape':   [n_frames] + list(frame_shape),
+                                    'bytes':   n_frames * frame_bytes,
+                                    'used':    time.time()})
+
+    def get(self, vid_path, gray=False, scale=None):
+        """ Returns the frames of a video (read-only array), decoding it only if it is not in the cache """
+
+        if not os.path.isfile(vid_path):
+            raise OSError('Video file does not exist: ' + vid_path)
+
+        frames = self.lookup(vid_path, gray, scale)
+
+        if frames is None:
+            self.build(vid_path, gray, scale)
+            frames = self.lookup(vid_path, gray, scale)
+
+        return frames
+
+    def entries(self):
+        """ Returns the metadata of all cache entries (list of dicts, with their path under 'entry'),
+        from the least to the most recently used """
+
+        entries = []
+        for c_file in os.listdir(self.cache_dir):
+            if c_file.endswith('.json'):
+                base = os.path.join(self.cache_dir, c_file[:-len('.json')])
+                meta = read_meta(base + '.json')
+                if meta is not None:
+                    meta['entry'] = base
+                    entries.append(meta)
+
+        return sorted(entries, key=lambda meta: meta['used'])
+
+    def evict(self, n_bytes=0):
+        """ Removes the least recently used entries until n_bytes more fit within the size budget """
+
+        entries = self.entries()
+        total = sum([meta['bytes'] for meta in entries])
+
+        for meta in entries:
+            if total + n_bytes <= self.max_bytes:
+                break
+            self.remove(meta['entry'])
+            total -= meta['bytes']
+
+    def remove(self, base):
+        """ Removes a cache entry (frames already mapped by a reader stay readable until it is done) """
+
+        for ext in ('.u8', '.json'):
+            if os.path.isfile(base + ext):
+                os.remove(base + ext)
+
+    def clear(self):
+        """ Removes all cache entries """
+
+        for meta in self.entries():
+            self.remove(meta['entry'])
+
+
+def read_meta(meta_path):
+    """ Returns the metadata of a cache entry (dict), or None if it is missing """
+
+    if not os.path.isfile(meta_path):
+        return None
+
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_meta(meta_path, meta):
+    """ Writes the metadata of a cache entry, replacing the file at once so that readers never see it partly written """
+
+    tmp_path = meta_path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
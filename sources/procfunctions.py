@@ -6,21 +6,33 @@ import pandas as pd
 import numpy as np
 import os.path as ph
 import glob
+import re
+
+from catalog import get_catalog
+import datastore as ds
 
 import pltFunctions as pt
 
 
-def refine_all(raw_coord_path, refine_coord_path, cat_path):
+# Filename of the manifest of derived sequences (kept with the derived data)
+MANIFEST_NAME = 'derived_manifest.csv'
+
+
+def refine_all(raw_coord_path, refine_coord_path, cat_path, workers=1, fmt='pkl.xz', compression=None,
+               quantile=0.05, force=False):
     """ Loops through all raw DLC coord files and generates refined coord files, using refine_data 
     
     raw_coord_path:     Path of raw coord data, as generated by DLC
     refine_coord_path:  Path to refined coord data
     cat_path:           Path to video catalog file
-    """
+    workers:            Number of processes for running files in parallel (1 runs them in series)
+    fmt:                Storage format of refined files: 'pkl.xz' (legacy), 'parquet' or 'feather'
+    compression:        Codec for columnar formats (e.g., 'zstd', 'lz4', 'uncompressed'), see datastore
+    quantile:           Bounds for identifying outliers (see fix_outlier_coord)
+    force:              Whether to remake files that are up to date with their input and parameters
 
-    fr_rate    = 1;
-    land_types = ['arm','chip']
-    arm_nums   = np.arange(5)+1
+    Returns a dataframe summarizing the output path, processing time, any error and whether each file was skipped.
+    """
 
     # Load list of DLC raw data files
     if ph.isdir(raw_coord_path):
@@ -28,147 +40,270 @@ def refine_all(raw_coord_path, refine_coord_path, cat_path):
     else:
         raise ValueError('vid_path not recognized')
 
-    # Load video catalog
-    cat = pd.read_csv(cat_path)
+    # Parse video catalog and check storage format before starting
+    get_catalog(cat_path)
+    ds.check_format(fmt)
 
-    # Loop thru all raw coord files in d_files
-    for c_path in d_files:
+    # Run all raw coord files in d_files
+    summary = run_batch(refine_file, d_files, workers, 
+                        refine_coord_path=refine_coord_path, cat_path=cat_path,
+                        fmt=fmt, compression=compression, quantile=quantile, force=force)
 
-        # Load current DLC raw coord from list
-        c_filename = ph.basename(c_path)
-        df_raw     = pd.read_hdf(c_path)
+    print('---------------------------------------------------------')
+    print('Completed generating refined data files from raw data')
 
-        # Define rows of catalog that have useful data
-        loc_data = np.arange(np.where(pd.isna(cat.date))[0][0])
+    return summary
 
-        # index of data (loc_cat) from video catalog that matches sequence
-        i_start = int(11)
-        i_end = int(c_filename.index('DLC'))
 
-        # find location (row) of the catalog that matches the data filename
-        trials = cat.trial_num[loc_data]
-        dates  = cat.date[loc_data]
-        i_cat_seq = (dates==c_filename[0:10]) & (trials.astype('int')==int(c_filename[i_start:i_end]))
-        loc_cat = np.where(i_cat_seq)[0]
+def refine_file(c_path, refine_coord_path, cat_path, fmt='pkl.xz', compression=None, quantile=0.05, 
+                force=False):
+    """ Generates and saves the refined coord file for a single raw DLC coord file, using refine_data 
 
-        # Check that only one match found in catalog spreadsheet
-        if len(loc_cat)<1:
-            raise ValueError('No matching sequence found in video_catalog')
-        elif len(loc_cat)>1:
-            raise ValueError('More than one matching sequence found in video_catalog')
-        
-        # Output filename for the data
-        seq_str = '0' + c_filename[i_start:i_end]
-        f_name_save = c_filename[0:10] + '_' + seq_str[-2:] + '_refined' + '.pkl.xz'
+    c_path:             Path of the raw coord file, as generated by DLC
+    refine_coord_path:  Path to refined coord data
+    cat_path:           Path to video catalog file
+    fmt:                Storage format of the refined file
+    compression:        Codec for columnar formats
+    quantile:           Bounds for identifying outliers (see fix_outlier_coord)
+    force:              Whether to remake the file, if up to date with its input and parameters
 
-        # From catalog: Current orientation
-        c_orient = int(cat.orientation[loc_cat])
+    Returns the path of the refined coord file and a dict noting whether it was skipped.
+    """
 
-        # Flip y, if 0 orientation
-        if c_orient==0:
-            y_height = cat.roi_h.values[loc_cat][0]
-        else:
-            y_height = 0
+    fr_rate    = 1;
 
-        # Define refined dataframe from raw dataframe
-        df = refine_data(df_raw, land_types, arm_nums, y_height,fr_rate)
+    # Current DLC raw coord from list
+    c_filename = ph.basename(c_path)
 
-        # write to disk
-        ref_path = refine_coord_path+ph.sep+f_name_save
-        df.to_pickle(ref_path,compression='infer')
+    # index of data (loc_cat) from video catalog that matches sequence
+    i_start = int(11)
+    i_end = int(c_filename.index('DLC'))
 
-        # Update status
-        print('   Refined data file saved to disk:' + ref_path)
+    # find row of the catalog that matches the data filename
+    cat_row = get_catalog(cat_path).get_row(c_filename[0:10], c_filename[i_start:i_end])
+    
+    # Output filename for the data
+    seq_str = '0' + c_filename[i_start:i_end]
+    f_name_save = c_filename[0:10] + '_' + seq_str[-2:] + '_refined'
 
-    print('---------------------------------------------------------')
-    print('Completed generating refined data files from raw data')
+    # From catalog: Current orientation
+    c_orient = int(cat_row.orientation)
+
+    # Flip y, if 0 orientation
+    if c_orient==0:
+        y_height = cat_row.roi_h
+    else:
+        y_height = 0
+
+    # Skip, if output is up to date with the input and parameters
+    params = {'quantile': quantile, 'y_height': float(y_height), 'fr_rate': fr_rate, 'fmt': fmt, 
+              'compression': compression}
+    stamp  = ds.input_stamp(c_path, params)
+    ref_path = refine_coord_path+ph.sep+f_name_save+ds.format_ext(fmt)
+    if (not force) and ds.stamp_current(ref_path, stamp):
+        return ref_path, {'skipped': True}
+
+    # Define refined dataframe from raw dataframe
+    df_raw = pd.read_hdf(c_path)
+    df = refine_data(df_raw, y_height=y_height, fr_rate=fr_rate, quantile=quantile)
+
+    # write to disk
+    ref_path = ds.save_data(df, refine_coord_path+ph.sep+f_name_save, fmt, compression)
+    ds.write_stamp(ref_path, stamp)
+
+    return ref_path, {'skipped': False}
+
+
+def run_batch(func, d_files, workers=1, **kwargs):
+    """ Runs func(c_path, **kwargs) on each file in d_files, in series or over a pool of processes.
+    An error in one file is recorded and does not stop the batch.
+
+    func:       Function to run on each file, returning the output path (or the path and a dict of info)
+    d_files:    List of input file paths
+    workers:    Number of processes (1 runs the files in series)
+    kwargs:     Arguments passed to func
+
+    Returns a dataframe with the input path, output path, processing time (s), error and any info for each file.
+    """
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    # Run files in series or parallel
+    if workers is None or workers>1:
+        results = [None]*len(d_files)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(run_timed, func, c_path, kwargs): i 
+                       for i, c_path in enumerate(d_files)}
+
+            # Report each file as it finishes
+            for c_future in as_completed(futures):
+                i = futures[c_future]
+                results[i] = c_future.result()
+                report_result(d_files[i], *results[i])
+    else:
+        results = []
+        for c_path in d_files:
+            results.append(run_timed(func, c_path, kwargs))
+            report_result(c_path, *results[-1])
+
+    summary = pd.DataFrame([r[:3] for r in results], columns=['out_path','time_s','error'])
+    summary.insert(0, 'in_path', d_files)
+
+    # Add info returned by func
+    info = pd.DataFrame([r[3] for r in results], index=summary.index)
+    summary = pd.concat([summary, info], axis=1)
+
+    # Report skipped files and failures
+    if 'skipped' in summary.columns:
+        n_skip = int((summary.skipped==True).sum())
+        if n_skip>0:
+            print('   ' + str(n_skip) + ' of ' + str(len(summary)) + ' files up to date (skipped)')
+    n_err = int(summary.error.notna().sum())
+    if n_err>0:
+        print('   ' + str(n_err) + ' of ' + str(len(summary)) + ' files failed')
 
+    return summary
 
-def refine_data(df_raw, land_types, arm_nums, y_height,fr_rate):
+
+def run_timed(func, c_path, kwargs):
+    """ Runs func(c_path, **kwargs), returning its output path, the elapsed time (s), any error message 
+    and a dict of any info returned with the path """
+
+    import time
+    import traceback
+
+    t_start = time.perf_counter()
+    info    = {}
+    try:
+        out_path = func(c_path, **kwargs)
+        error    = None
+
+        # Separate path from info
+        if isinstance(out_path, tuple):
+            out_path, info = out_path
+    except Exception:
+        out_path = None
+        error    = traceback.format_exc()
+
+    return out_path, time.perf_counter()-t_start, error, info
+
+
+def report_result(c_path, out_path, time_s, error, info=None):
+    """ Prints the status of a single file processed by run_batch """
+
+    if (error is None) and (info or {}).get('skipped', False):
+        print('   Up to date, skipped: ' + out_path)
+    elif error is None:
+        print('   Data file saved to disk (' + format(time_s,'.1f') + ' s): ' + out_path)
+    else:
+        print('   FAILED: ' + c_path)
+        print('   ' + error.strip().splitlines()[-1])
+
+
+def refine_data(df_raw, land_types=None, arm_nums=None, y_height=0, fr_rate=1, quantile=0.05):
     """ Accepts raw DLC coordinate datatable (df_raw) and outputs newly-organized datatable
     
     df_raw:     Data frame of raw coordinates (as generated by DLC)
-    land_types: Types of landmarks (e.g., 'arm', 'chip') 
-    arm_nums:   List of arm numbers (0,1,2,3,4) 
+    land_types: Types of landmarks (e.g., 'arm', 'chip'). Defaults to all types found in df_raw
+    arm_nums:   List of arm numbers (1,2,3,4,5). Defaults to all numbers found in df_raw
     y_height:   Vertical height of video frame
     fr_rate:    Frame rate of video recording
+    quantile:   Bounds for identifying outliers (see fix_outlier_coord)
     """
 
-    # Read data and extract 'scorer' value from DLC
-    scorer = list(df_raw)[0][0]
-
-    # Initialize series to receive columns of data
-    # df = pd.DataFrame
-    fr_num      = pd.Series(dtype='int')
-    time_s      = pd.Series(dtype='float')
-    body_pos    = pd.Series(dtype='str')
-    arm_num     = pd.Series(dtype='int')
-    dim         = pd.Series(dtype='str')
-    coord_pix   = pd.Series(dtype='float')
-    # coord_pix = np.array([],dtype='float')
+    # Read the DLC header once
+    scorer, parts = dlc_schema(df_raw)
 
-    # Gather values for writing to new dataframe ---------------------
+    # Keep only the requested landmarks
+    if land_types is not None:
+        parts = [p for p in parts if p[0] in list(land_types)]
+    if arm_nums is not None:
+        parts = [p for p in parts if p[1] in [int(n) for n in arm_nums]]
 
-    # Loop thru types of landmarks
-    for c_land in land_types:
+    if len(parts)==0:
+        raise ValueError('No matching bodyparts found in DLC data')
 
-        # Loop thru arm numbers
-        for c_arm in arm_nums:
+    # Frame numbers and dimensions of the output
+    fr_num  = df_raw.index.to_numpy()
+    n_fr    = len(fr_num)
+    n_parts = len(parts)
 
-                # Define current part number
-                part_name = c_land + str(c_arm)
+    # Pull x,y of all bodyparts as one block (frames x bodyparts x 2)
+    part_names = [c_land + str(c_arm) for c_land, c_arm in parts]
+    cols  = pd.MultiIndex.from_product([part_names, ['x','y']])
+    block = np.array(df_raw[scorer].reindex(columns=cols), dtype='float')
+    block = block.reshape(n_fr, n_parts, 2)
 
-                # Extract coordinates from DLC data for current landmark
-                x = df_raw[scorer][part_name]['x']
-                y = df_raw[scorer][part_name]['y']
+    # Remove outlier points of all bodyparts in one call
+    block[:,:,0], block[:,:,1] = fix_outlier_coord(block[:,:,0], block[:,:,1], quantile)
 
-                # Remove outlier points
-                x,y = fix_outlier_coord(x,y,0.05)
+    # Flip y, if 0 orientation
+    block[:,:,1] = np.abs(y_height - block[:,:,1])
 
-                # Flip y, if 0 orientation
-                y = np.abs(y_height - y)
+    # Values ordered by bodypart, then dimension, then frame
+    coord_pix = block.transpose(1,2,0).ravel()
 
-                # Make list of 'x' and 'y' as strings to designate the dimensions
-                x_dim     = pd.Series('x').repeat(len(x))
-                y_dim     = pd.Series('y').repeat(len(y))
-
-                c_frame_num = pd.Series(np.concatenate([x.index,y.index]))
-                # Cue up the columns of data
-                
-                dim       = pd.concat([dim, pd.Series(np.concatenate([x_dim,y_dim]))])
-                # coord_pix = pd.concat([coord_pix, pd.Series(np.concatenate([x,y]))])
-                coord_pix = np.concatenate([coord_pix,x,y])
-                fr_num    = pd.concat([fr_num, c_frame_num])
-                time_s    = pd.concat([time_s, c_frame_num/fr_rate])
-                body_pos  = pd.concat([body_pos, pd.Series(c_land).repeat(len(c_frame_num))])
-                arm_num   = pd.concat([arm_num, pd.Series(c_arm).repeat(len(c_frame_num))])
-
-    # Reset indicies
-    fr_num    = fr_num.reset_index(drop=True)
-    time_s    = time_s.reset_index(drop=True)
-    body_pos  = body_pos.reset_index(drop=True)
-    arm_num   = arm_num.reset_index(drop=True)
-    dim       = dim.reset_index(drop=True)
+    # Build index in a single step
+    body_pos = np.repeat([p[0] for p in parts], 2*n_fr)
+    arm_num  = np.repeat([p[1] for p in parts], 2*n_fr)
+    dim      = np.tile(np.repeat(['x','y'], n_fr), n_parts)
+    fr_nums  = np.tile(fr_num, 2*n_parts)
+    idx = pd.MultiIndex.from_arrays([body_pos,arm_num,dim,fr_nums],
+                    names=['body_pos','arm_num','dim','fr_num'])
 
     # Pile into dataframe
-    df = pd.DataFrame(coord_pix,index=[body_pos,arm_num,dim,fr_num],columns=['coord_pix'])
-    df.index.names = ['body_pos','arm_num','dim','fr_num']
+    df = pd.DataFrame({'coord_pix': coord_pix}, index=idx)
 
     return df
 
 
+def dlc_schema(df_raw):
+    """ Reads the header of a DLC datatable and returns the scorer and the landmarks it holds.
+    Bodypart names are expected as a landmark type followed by a number (e.g., 'arm1', 'chip3'). 
+    Other bodyparts (e.g., 'head') are skipped.
+
+    df_raw:     Data frame of raw coordinates (as generated by DLC)
+
+    Returns the scorer name and a sorted list of (landmark type, number) tuples.
+    """
+
+    # DLC columns are (scorer, bodyparts, coords)
+    scorer = df_raw.columns.get_level_values(0)[0]
+    names  = df_raw[scorer].columns.get_level_values(0).unique()
+
+    # Split each bodypart name into its type and number
+    parts = []
+    for c_name in names:
+        c_match = re.match(r'^(.*?)(\d+)$', c_name)
+        if c_match is not None:
+            parts.append((c_match.group(1), int(c_match.group(2))))
+
+    return scorer, sorted(parts)
+
+
 def fix_outlier_coord(x,y,quantile=0.25):
     """ Scans through DLC coodinate data, identifies outliers, and replaces them with linearly-interpolated values.
     
-    x,y:        Coordinates
+    x,y:        Coordinates, either 1-D (frames) or 2-D (frames x bodyparts)
     quantile:   Identifies the bounds of the outlier (0.25 = quartile)
+
+    Returns x,y in the same form as given (array, Series or DataFrame).
     """
 
+    # Work on 2-D float copies (frames x bodyparts)
+    x_arr = np.array(x, dtype='float')
+    y_arr = np.array(y, dtype='float')
+    one_dim = x_arr.ndim==1
+    if one_dim:
+        x_arr = x_arr[:,np.newaxis]
+        y_arr = y_arr[:,np.newaxis]
+    n_fr = x_arr.shape[0]
+
     # Displacement btwn points
-    disp = np.sqrt(np.power(np.diff(x),2) + np.power(np.diff(y),2))
+    disp = np.hypot(np.diff(x_arr,axis=0), np.diff(y_arr,axis=0))
 
-    # find q1 and q3 values
-    q1, q3 = np.percentile(sorted(disp), [100*quantile, 100-100*quantile])
+    # find q1 and q3 values of each bodypart
+    q1, q3 = np.percentile(disp, [100*quantile, 100-100*quantile], axis=0)
  
     # compute IRQ (Interquartile range)
     iqr = q3 - q1
@@ -178,81 +313,225 @@ def fix_outlier_coord(x,y,quantile=0.25):
     upper_bound = q3 + (1.5 * iqr)
     
     # Identify outliers
-    outliers = [x for x in disp if x <= lower_bound or x >= upper_bound]
+    is_out = (disp <= lower_bound) | (disp >= upper_bound)
     
     # Raise error, if too many outliers
-    if len(outliers) > len(x)/10:
+    if np.any(np.sum(is_out,axis=0) > n_fr/10):
         raise ValueError('Too many outlier values here. Try reducing quantile value')
 
-    # Interpolate over outlier values, if they exist
-    elif len(outliers)>0:
+    # Flag the point after each outlier step (or the first point, for the first step)
+    bad = np.zeros(x_arr.shape, dtype=bool)
+    bad[0]  = is_out[0]
+    bad[2:] = is_out[1:]
+
+    # Interpolate over all flagged points of each bodypart at once
+    pts = np.arange(n_fr)
+    for i_col in np.where(np.any(bad,axis=0))[0]:
+
+        good   = ~bad[:,i_col]
+        i_good = pts[good]
+        i_bad  = pts[~good]
+
+        for c_arr in (x_arr, y_arr):
+            vals = c_arr[good,i_col]
+            c_arr[i_bad,i_col] = np.interp(i_bad, i_good, vals)
+
+            # Extrapolate linearly beyond the first and last good points
+            if len(i_good)>1:
+                i_pre  = i_bad[i_bad<i_good[0]]
+                i_post = i_bad[i_bad>i_good[-1]]
+                c_arr[i_pre,i_col]  = vals[0] + (i_pre-i_good[0]) * \
+                                      (vals[1]-vals[0])/(i_good[1]-i_good[0])
+                c_arr[i_post,i_col] = vals[-1] + (i_post-i_good[-1]) * \
+                                      (vals[-1]-vals[-2])/(i_good[-1]-i_good[-2])
+
+    if one_dim:
+        x_arr = x_arr[:,0]
+        y_arr = y_arr[:,0]
+
+    # Return in the form given
+    if isinstance(x, pd.Series):
+        x_arr = pd.Series(x_arr, index=x.index, name=x.name)
+        y_arr = pd.Series(y_arr, index=y.index, name=y.name)
+    elif isinstance(x, pd.DataFrame):
+        x_arr = pd.DataFrame(x_arr, index=x.index, columns=x.columns)
+        y_arr = pd.DataFrame(y_arr, index=y.index, columns=y.columns)
+
+    return x_arr, y_arr
+
+
+def derive_all(refine_coord_path, f_suffix=None, heading_win=10, workers=1, fmt='pkl.xz', compression=None,
+               cat_path=None, force=False):
+    """ Loops through all refined sequences to calculate derived variables (e.g., centroid, heading) from refined data.
 
-        # Loop thru outlier values
-        for idx in range(len(outliers)):
-            
-            # Location of outlier value
-            i_out = np.where(disp==outliers[idx])[0][0]
+    refine_coord_path:  Path to refined data
+    f_suffix:           File suffix for data files (defaults to '*refined' with the extension of fmt)
+    heading_win:        Number of points skipped to calculate heading from displacement
+    workers:            Number of processes for running files in parallel (1 runs them in series)
+    fmt:                Storage format of refined and derived files: 'pkl.xz' (legacy), 'parquet' or 'feather'
+    compression:        Codec for columnar formats (e.g., 'zstd', 'lz4', 'uncompressed'), see datastore
+    cat_path:           Path to video catalog file, for adding the angle of each sequence to the manifest
+    force:              Whether to remake files that are up to date with their input and parameters
+
+    Also writes a manifest of the extents of each derived sequence (see update_manifest).
+    Returns a dataframe summarizing the output path, processing time, any error and whether each file was skipped.
+    """
+
+    # Match suffix to storage format
+    if f_suffix is None:
+        f_suffix = '*refined' + ds.format_ext(fmt)
 
-            # If it's the first value . . .
-            if np.max(i_out==0):
-                x[0] = x[1]-(x[2]-x[1])
-                y[0] = y[1]-(y[2]-y[1])
+    #  Load list of DLC raw data files
+    if ph.isdir(refine_coord_path):
+        d_files = glob.glob(refine_coord_path + ph.sep + f_suffix)
+    else:
+        raise ValueError('vid_path not recognized')
 
-            # If it's the last value . . .
-            elif np.max(i_out==len(disp)):
-                x[len(x)-1] = x[len(x)-2] + (x[len(x)-2]-x[len(x)-3])
-                y[len(y)-1] = y[len(y)-2] + (y[len(y)-2]-y[len(y)-3])
+    # Run all data files
+    summary = run_batch(derive_file, d_files, workers, 
+                        refine_coord_path=refine_coord_path, heading_win=heading_win,
+                        fmt=fmt, compression=compression, force=force)
 
-            # If it's a value in the middle
-            else:
-                # Tweak index
-                i_out = i_out+1
+    # Record extents of the derived sequences
+    if len(summary)>0:
+        man_path = update_manifest(refine_coord_path, summary, cat_path)
+        print('   Manifest saved to disk: ' + man_path)
 
-                # Define values that skip the outlier
-                vals        = np.concatenate((x.index[0:i_out],x.index[i_out+1:])) 
-                xTmp        = np.concatenate((x[0:i_out],x[i_out+1:]))  
-                yTmp        = np.concatenate((y[0:i_out],y[i_out+1:]))   
+    print('---------------------------------------------------------')
+    print('Completed generating derived data files from refined data')
 
-                # Replace faulty coordinate
-                x[i_out]    = np.interp(i_out,vals,xTmp);
-                y[i_out]    = np.interp(i_out,vals,yTmp);
-    return x, y
+    return summary
 
 
-def derive_all(refine_coord_path, f_suffix='*refined.pkl.xz', heading_win=10):
-    """ Loops through all refined sequences to calculate derived variables (e.g., centroid, heading) from refined data.
+def derive_file(c_path, refine_coord_path, heading_win=10, fmt='pkl.xz', compression=None, force=False):
+    """ Calculates and saves derived variables for a single refined sequence, using derive_data
 
+    c_path:             Path of the refined data file (in any storage format)
     refine_coord_path:  Path to refined data
-    f_suffix:           File suffix for data files
     heading_win:        Number of points skipped to calculate heading from displacement
+    fmt:                Storage format of the derived file
+    compression:        Codec for columnar formats
+    force:              Whether to remake the file, if up to date with its input and parameters
+
+    Returns the path of the derived data file and a dict of its extents (see summarize_derived),
+    or only whether it was skipped.
     """
 
-    #  Load list of DLC raw data files
-    if ph.isdir(refine_coord_path):
-        d_files = glob.glob(refine_coord_path + ph.sep + f_suffix)
+    # Output filename for the data
+    f_name_save = ph.basename(c_path)[:13] + '_derived'
+
+    # Skip, if output is up to date with the input and parameters
+    params = {'heading_win': heading_win, 'fmt': fmt, 'compression': compression}
+    stamp  = ds.input_stamp(c_path, params)
+    ref_path = refine_coord_path+ph.sep+f_name_save+ds.format_ext(fmt)
+    if (not force) and ds.stamp_current(ref_path, stamp):
+        return ref_path, {'skipped': True}
+
+    # Load dataframe from current path
+    df = ds.load_data(c_path)
+
+    # Calculate derived data
+    df_der = derive_data(df, heading_win=heading_win)
+
+    # write to disk
+    ref_path = ds.save_data(df_der, refine_coord_path+ph.sep+f_name_save, fmt, compression)
+    ds.write_stamp(ref_path, stamp)
+
+    return ref_path, dict(skipped=False, **summarize_derived(df_der))
+
+
+def summarize_derived(df_der):
+    """ Returns a dict of the extents of a derived sequence, as used for setting plot axes.
+
+    df_der:     Dataframe of derived data
+    """
+
+    return {'num_frames':   len(df_der),
+            'duration_s':   np.max(df_der.time_s) - np.min(df_der.time_s),
+            't_min':        np.min(df_der.time_s),
+            't_max':        np.max(df_der.time_s),
+            'x_min':        np.min(df_der.x_cntr_pix),
+            'x_max':        np.max(df_der.x_cntr_pix),
+            'x_mean':       np.mean(df_der.x_cntr_pix),
+            'y_min':        np.min(df_der.y_cntr_pix),
+            'y_max':        np.max(df_der.y_cntr_pix),
+            'spd_min':      np.min(df_der.spd_pixs),
+            'spd_max':      np.max(df_der.spd_pixs),
+            'head_min':     np.min(df_der.head_rad),
+            'head_max':     np.max(df_der.head_rad)}
+
+
+def update_manifest(refine_coord_path, summary, cat_path=None):
+    """ Adds the sequences of a derive_all run to the manifest in refine_coord_path (replacing older 
+    entries for the same files) and returns the path of the manifest.
+
+    refine_coord_path:  Path to refined data, where the manifest is kept
+    summary:            Dataframe returned by run_batch for derive_file
+    cat_path:           Path to video catalog file, for the angle of each sequence
+    """
+
+    man_path = refine_coord_path + ph.sep + MANIFEST_NAME
+
+    # Sequences made in this run (skipped ones keep their previous entries)
+    new = summary.loc[summary.error.isna() & (summary.get('skipped', False)==False)]
+    new = new.drop(columns=['in_path','time_s','error','skipped'], errors='ignore')
+    if len(new)==0:
+        return man_path
+
+    new = new.rename(columns={'out_path': 'path'})
+    new.insert(0, 'file', [ph.basename(c_path) for c_path in new.path])
+
+    # Angle of each sequence, from the catalog
+    if cat_path is not None:
+        new['angle_deg'] = [get_cat_value(cat_path, c_file[:10], c_file[11:13], 'angle_deg') 
+                            for c_file in new.file]
+
+    # Merge with previous runs
+    if ph.isfile(man_path):
+        man = pd.read_csv(man_path)
+        man = pd.concat([man.loc[~man.file.isin(new.file)], new], ignore_index=True)
     else:
-        raise ValueError('vid_path not recognized')
+        man = new.reset_index(drop=True)
 
-    # Loop thru data files
-    for c_path in d_files:
+    man.to_csv(man_path, index=False)
 
-        # Load dataframe from current path
-        df = pd.read_pickle(c_path)
+    return man_path
 
-        # Calculate derived data
-        df_der = derive_data(df, heading_win=heading_win)
 
-        # write to disk
-        f_name_save = ph.basename(c_path)[:13] + '_derived.pkl.xz'
-        ref_path = refine_coord_path+ph.sep+f_name_save
-        df_der.to_pickle(ref_path,compression='infer')
+def get_manifest(refine_coord_path, d_files, cat_path):
+    """ Returns the manifest rows for the derived data files d_files, in the same order.
+    Files missing from the manifest are summarized by loading them, and missing angles are read from the catalog.
 
-        # Update status
-        print('Derived data file saved to disk:')
-        print('     ' + ref_path)
+    refine_coord_path:  Path to refined data, where the manifest is kept
+    d_files:            List of paths to derived data files
+    cat_path:           Path to video catalog file
+    """
 
-    print('---------------------------------------------------------')
-    print('Completed generating derived data files from refined data')
+    man_path = refine_coord_path + ph.sep + MANIFEST_NAME
+
+    # Read manifest, if it exists
+    if ph.isfile(man_path):
+        man = pd.read_csv(man_path).set_index('file')
+    else:
+        man = pd.DataFrame()
+
+    rows = []
+    for c_file in d_files:
+        c_name = ph.basename(c_file)
+
+        if c_name in man.index:
+            c_row = man.loc[c_name].to_dict()
+        else:
+            c_row = summarize_derived(ds.load_data(c_file))
+
+        # Angle for current sequence
+        if pd.isna(c_row.get('angle_deg', np.nan)):
+            c_row['angle_deg'] = get_cat_value(cat_path, c_name[:10], c_name[11:13], 'angle_deg')
+
+        c_row['path'] = c_file
+        rows.append(c_row)
+
+    return pd.DataFrame(rows)
 
 
 def derive_data(df,heading_win=10):
@@ -262,156 +541,67 @@ def derive_data(df,heading_win=10):
     heading_win:        Number of points skipped to calculate heading from displacement
     """
 
-    import numpy.matlib
+    # Parameters
+    fr_rate    = 1
 
-    # For calculating a running average (smoothing)
-    def running_mean(x, N=10):
-        out = np.zeros_like(x, dtype=np.float64)
-        dim_len = x.shape[0]
-        for i in range(dim_len):
-            if N%2 == 0:
-                a, b = i - (N-1)//2, i + (N-1)//2 + 2
-            else:
-                a, b = i - (N-1)//2, i + (N-1)//2 + 1
+    # Pivot refined data into dense arrays (frames x arms x xy)
+    fr_num, arm_nums, chip_xy, arm_xy = refined_to_array(df)
+    n_fr   = len(fr_num)
+    n_arms = len(arm_nums)
 
-            #cap indices to min and max indices
-            a = max(0, a)
-            b = min(dim_len, b)
-            out[i] = np.mean(x[a:b])
-        return out
+    # Time of each frame
+    time_s = fr_num/fr_rate
 
-    # Parameters
-    arm_nums   = np.arange(5)+1
-    fr_rate    = 1
+    # Center position, as the mean of the chips
+    x_cntr_pix = np.mean(chip_xy[:,:,0],axis=1)
+    y_cntr_pix = np.mean(chip_xy[:,:,1],axis=1)
 
-    # List of sorted unique frame numbers
-    fr_nums = df.loc[('arm',1,'x'),:].index.unique()
-    fr_nums.sort_values()
-
-    # Initialize series for columns of data
-    fr_num      = pd.Series(dtype='int')
-    time_s      = pd.Series(dtype='float')
-    x_cntr_pix  = pd.Series(dtype='float')
-    y_cntr_pix  = pd.Series(dtype='float')
-    x_arm1_pix  = pd.Series(dtype='float')
-    y_arm1_pix  = pd.Series(dtype='float')
-    x_arm2_pix  = pd.Series(dtype='float')
-    y_arm2_pix  = pd.Series(dtype='float')
-    x_arm3_pix  = pd.Series(dtype='float')
-    y_arm3_pix  = pd.Series(dtype='float')
-    x_arm4_pix  = pd.Series(dtype='float')
-    y_arm4_pix  = pd.Series(dtype='float')
-    x_arm5_pix  = pd.Series(dtype='float')
-    y_arm5_pix  = pd.Series(dtype='float')
-
-    # Arrays for tracking previous coords and radial position
-    last_coord = np.empty((1,5,))[0]*np.nan
-    last_rad   = np.nan
-
-    # Loop through time
-    for frame in fr_nums:
-
-        # Coordinate containers
-        c_x = np.array([],dtype='float')
-        c_y = np.array([],dtype='float')
-        a_x = np.array([],dtype='float')
-        a_y = np.array([],dtype='float')
-
-        # Loop thru arms, extract coords for current frame
-        for c_arm in arm_nums:             
-            c_loc  = np.where(df.loc[('chip',c_arm,'x'),:].index==frame)[0]
-            c_x    = np.append(c_x,
-                    df.loc[('chip',c_arm,'x'),:].coord_pix[c_loc])
-            c_y    = np.append(c_y,
-                    df.loc[('chip',c_arm,'y'),:].coord_pix[c_loc])
-            a_x    = np.append(a_x,
-                    df.loc[('arm',c_arm,'x'),:].coord_pix[c_loc])
-            a_y    = np.append(a_y,
-                    df.loc[('arm',c_arm,'y'),:].coord_pix[c_loc])
-            
-        # Store time
-        c_time      = df.loc[('chip',c_arm,'x'),:].index[c_loc][0]/fr_rate
-        fr_num      = pd.concat([fr_num, pd.Series(frame)])
-        time_s      = pd.concat([time_s, pd.Series(c_time)])
-
-        # Store center position
-        x_cntr_pix = pd.concat([x_cntr_pix, pd.Series(np.mean(c_x))])
-        y_cntr_pix = pd.concat([y_cntr_pix, pd.Series(np.mean(c_y))])
-
-        # Find radial positions of the arms
-        c_rad = np.arctan2(a_y-np.mean(c_y),a_x-np.mean(c_x))
-
-        # On first frame, identify lead arm as the one pointing up
-        if np.max(np.isnan(last_coord)):
-            vert_diff = abs(np.pi/2-np.arctan2(a_y-np.mean(c_y),a_x-np.mean(c_x)))
-            loc_arm_up = np.where(vert_diff==np.min(vert_diff))
-            # loc_arm_up = np.where(a_y==np.max(a_y))[0]
-  
-        # Identify the lead arm as the one closest to the previous
+    # Radial positions of the arms
+    c_rad = np.arctan2(arm_xy[:,:,1]-y_cntr_pix[:,np.newaxis],
+                       arm_xy[:,:,0]-x_cntr_pix[:,np.newaxis])
+
+    # Identify the lead arm in each frame
+    lead = np.zeros(n_fr, dtype='int')
+    for i_fr in range(n_fr):
+
+        # On first frame (or after lost coords), lead arm is the one pointing up
+        if i_fr==0 or np.any(np.isnan(arm_xy[i_fr-1,lead[i_fr-1]])):
+            lead[i_fr] = np.argmin(np.abs(np.pi/2-c_rad[i_fr]))
+
+        # Otherwise, the lead arm is the one closest to the previous
         else:
-            rad_c = np.abs(c_rad-np.matlib.repmat(last_rad,1,5))[0]
-            loc_arm_up = np.where(rad_c==np.min(rad_c))
-            # disp = np.hypot(a_x-last_coord[0],a_y-last_coord[1])
-            # loc_arm_up = np.where(disp==np.min(disp))
-            
-        # Order the other arms by radial position CCW wrt arm1
-        arm_order = np.argsort(np.unwrap(c_rad-c_rad[loc_arm_up]))
-
-        # Store arm coords in order
-        x_arm1_pix = pd.concat([x_arm1_pix, pd.Series(a_x[arm_order[0]])])
-        y_arm1_pix = pd.concat([y_arm1_pix, pd.Series(a_y[arm_order[0]])])
-        x_arm2_pix = pd.concat([x_arm2_pix, pd.Series(a_x[arm_order[1]])])
-        y_arm2_pix = pd.concat([y_arm2_pix, pd.Series(a_y[arm_order[1]])])
-        x_arm3_pix = pd.concat([x_arm3_pix, pd.Series(a_x[arm_order[2]])])
-        y_arm3_pix = pd.concat([y_arm3_pix, pd.Series(a_y[arm_order[2]])])
-        x_arm4_pix = pd.concat([x_arm4_pix, pd.Series(a_x[arm_order[3]])])
-        y_arm4_pix = pd.concat([y_arm4_pix, pd.Series(a_y[arm_order[3]])])
-        x_arm5_pix = pd.concat([x_arm5_pix, pd.Series(a_x[arm_order[4]])])
-        y_arm5_pix = pd.concat([y_arm5_pix, pd.Series(a_y[arm_order[4]])])
-
-        # Store coord as last
-        last_coord = np.array([a_x[loc_arm_up],a_y[loc_arm_up]])
-
-        # Store radial position as last
-        last_rad = c_rad[loc_arm_up]
-
-    # Smooth x and y coordinates
-    x_cntr_sm  = running_mean(x_cntr_pix, 20)
-    y_cntr_sm  = running_mean(y_cntr_pix, 20)
-    x_arm_sm   = running_mean(x_arm1_pix, 20)
-    y_arm_sm   = running_mean(y_arm1_pix, 20)
+            lead[i_fr] = np.argmin(np.abs(c_rad[i_fr]-c_rad[i_fr-1,lead[i_fr-1]]))
 
-    # Calculate heading from body orientation
-    head_rad = pd.Series(
-                np.arctan2(y_arm_sm-y_cntr_sm,x_arm_sm-x_cntr_sm),
-                dtype='float')
+    # Order the other arms by radial position CCW wrt the lead arm
+    lead_rad  = c_rad[np.arange(n_fr),lead][:,np.newaxis]
+    arm_order = np.argsort(np.unwrap(c_rad-lead_rad,axis=1),axis=1)
 
-    head_disp_rad  = pd.Series(dtype='float')
-    x_last = x_cntr_sm[0]; y_last = y_cntr_sm[0]
-    # Calculate heading from displacement
-    for c_pt in range(len(x_cntr_sm)-heading_win+1):
+    # Arm coords in order
+    arm_xy = np.take_along_axis(arm_xy, arm_order[:,:,np.newaxis], axis=1)
 
-        # Current angle value
-        c_ang = np.arctan2(y_cntr_sm[c_pt]-y_last,
-                         x_cntr_sm[c_pt]-x_last)
+    # Smooth x and y coordinates of the center and all arms in one call
+    xy_sm = running_mean(np.column_stack([x_cntr_pix, y_cntr_pix,
+                            arm_xy[:,:,0], arm_xy[:,:,1]]), 20)
+    x_cntr_sm = xy_sm[:,0]
+    y_cntr_sm = xy_sm[:,1]
+    x_arm_sm  = xy_sm[:,2:2+n_arms]
+    y_arm_sm  = xy_sm[:,2+n_arms:]
 
-        # Store value
-        head_disp_rad = pd.concat([head_disp_rad, 
-                        pd.Series(c_ang)])
+    # Calculate heading from body orientation
+    head_rad = np.arctan2(y_arm_sm[:,0]-y_cntr_sm,x_arm_sm[:,0]-x_cntr_sm)
 
-        x_last = x_cntr_sm[c_pt]; y_last = y_cntr_sm[c_pt]
+    # Calculate heading from displacement
+    n_head = max(n_fr-heading_win+1, 0)
+    head_disp_rad = np.arctan2(np.diff(y_cntr_sm,prepend=y_cntr_sm[:1]),
+                               np.diff(x_cntr_sm,prepend=x_cntr_sm[:1]))[:n_head]
 
     # Calculate speed (add redundant value at end)
-    spd = pd.Series(
-            np.hypot(np.diff(x_cntr_sm),np.diff(y_cntr_sm)),
-            dtype='float') / np.diff(time_s)
-    spd = np.append(spd,spd[-1:])
+    step = np.hypot(np.diff(x_cntr_sm),np.diff(y_cntr_sm))
+    spd  = step / np.diff(time_s)
+    spd  = np.append(spd,spd[-1:])
 
     # Displacement
-    displ = pd.Series(
-                np.cumsum(np.hypot(np.diff(x_cntr_sm),np.diff(y_cntr_sm))),
-                dtype='float'
-            )
+    displ = pd.Series(np.cumsum(step), dtype='float')
 
     # Plot smoothing on body center (diagnostic)
     if False:
@@ -420,68 +610,219 @@ def derive_data(df,heading_win=10):
     # Example of extracting values
     # tmp = df.loc[('arm',1,'x'),:].coord_pix
 
-    # reset indices
-    new_idx             = np.arange(len(fr_num))
-    fr_num.index        = new_idx
-    time_s.index        = new_idx
-    x_cntr_pix.index    = new_idx
-    y_cntr_pix.index    = new_idx
-    x_arm1_pix.index    = new_idx
-    y_arm1_pix.index    = new_idx
-    x_arm2_pix.index    = new_idx
-    y_arm2_pix.index    = new_idx
-    x_arm3_pix.index    = new_idx
-    y_arm3_pix.index    = new_idx
-    x_arm4_pix.index    = new_idx
-    y_arm4_pix.index    = new_idx
-    x_arm5_pix.index    = new_idx
-    y_arm5_pix.index    = new_idx
-    head_rad.index      = new_idx
-
-    # Set for displacement heading, add time vector
-    head_disp_rad.index = np.arange(len(head_disp_rad))
-    t_head_disp         = time_s[:len(head_disp_rad)]
-
     # dataframe for derived values
     d_frame = {'fr_num': fr_num,
             'time_s': time_s,
             'x_cntr_pix': x_cntr_sm,
-            'y_cntr_pix': y_cntr_sm,
-            'x_arm1_pix': x_arm_sm,
-            'y_arm1_pix': y_arm_sm,
-            'x_arm2_pix': x_arm_sm,
-            'y_arm2_pix': y_arm_sm,
-            'x_arm3_pix': x_arm_sm,
-            'y_arm3_pix': y_arm_sm,
-            'x_arm4_pix': x_arm_sm,
-            'y_arm4_pix': y_arm_sm,
-            'x_arm5_pix': x_arm_sm,
-            'y_arm5_pix': y_arm_sm,
-            'head_rad': head_rad,
-            'spd_pixs': spd,
-            'displ_pix': displ,
-            't_head_disp': t_head_disp,
-            'head_disp_rad': head_disp_rad
-            }  
-    df_der = pd.DataFrame(d_frame)
+            'y_cntr_pix': y_cntr_sm}
+    for i_arm in range(n_arms):
+        d_frame['x_arm' + str(i_arm+1) + '_pix'] = x_arm_sm[:,i_arm]
+        d_frame['y_arm' + str(i_arm+1) + '_pix'] = y_arm_sm[:,i_arm]
+    d_frame['head_rad']      = head_rad
+    d_frame['spd_pixs']      = spd
+    d_frame['displ_pix']     = displ
+    d_frame['t_head_disp']   = pd.Series(time_s[:n_head])
+    d_frame['head_disp_rad'] = pd.Series(head_disp_rad)
+
+    df_der = pd.DataFrame(d_frame, index=np.arange(n_fr))
 
     return df_der
 
 
-def plt_all_traj(refine_coord_path, cat_path, f_suffix='*derived.pkl.xz', save_path=None):
+def refined_to_array(df):
+    """ Pivots refined data into dense arrays of chip and arm coordinates.
+
+    df: dataframe of refined version of the data.
+
+    Returns the frame numbers, the arm numbers and arrays (frames x arms x xy) of the chip and arm coordinates.
+    """
+
+    # One row per frame, one column per landmark and dimension
+    wide = df.coord_pix.unstack(['body_pos','arm_num','dim'])
+
+    # Arm numbers present for both landmark types
+    arm_nums = np.intersect1d(wide['arm'].columns.get_level_values('arm_num'),
+                              wide['chip'].columns.get_level_values('arm_num'))
+
+    # Dense arrays of coordinates
+    shape = (len(wide), len(arm_nums), 2)
+    cols  = pd.MultiIndex.from_product([arm_nums, ['x','y']])
+    chip_xy = wide['chip'].reindex(columns=cols).to_numpy(dtype='float').reshape(shape)
+    arm_xy  = wide['arm'].reindex(columns=cols).to_numpy(dtype='float').reshape(shape)
+
+    return wide.index.to_numpy(), arm_nums, chip_xy, arm_xy
+
+
+def running_mean(x, N=10):
+    """ Running average (boxcar smoothing) along the first axis, computed from a cumulative sum.
+    Near the ends, the window is truncated to the available samples.
+
+    x:  Data to be smoothed, 1-D (samples) or 2-D (samples x columns)
+    N:  Number of samples in the averaging window
+    """
+
+    x = np.asarray(x, dtype='float')
+    n = x.shape[0]
+
+    # Window limits for each sample (even windows extend one more sample forward)
+    i = np.arange(n)
+    a = np.clip(i - (N-1)//2, 0, n)
+    b = np.clip(i + N//2 + 1, 0, n)
+
+    # Cumulative sums of values and of NaNs (so a NaN affects only its own windows)
+    is_nan = np.isnan(x)
+    pad    = np.zeros((1,) + x.shape[1:])
+    c_sum  = np.concatenate([pad, np.cumsum(np.where(is_nan,0,x), axis=0)])
+    c_nan  = np.concatenate([pad, np.cumsum(is_nan, axis=0)])
+
+    # Mean over each window
+    win_len = (b-a).reshape((n,) + (1,)*(x.ndim-1))
+    out = (c_sum[b]-c_sum[a]) / win_len
+    out[(c_nan[b]-c_nan[a]) > 0] = np.nan
+
+    return out
+
+
+def gauss_smooth(x, sigma=3):
+    """ Gaussian smoothing along the first axis. Near the ends, the kernel is truncated 
+    and renormalized to the available samples.
+
+    x:      Data to be smoothed, 1-D (samples) or 2-D (samples x columns)
+    sigma:  Standard deviation of the Gaussian kernel (in samples)
+    """
+
+    # Kernel, truncated at 3 standard deviations
+    half   = int(np.ceil(3*sigma))
+    t      = np.arange(-half, half+1)
+    kernel = np.exp(-0.5*(t/sigma)**2)
+
+    return conv_smooth(x, kernel)
+
+
+def savgol_smooth(x, N=11, order=2):
+    """ Savitzky-Golay smoothing along the first axis. Near the ends, the polynomial is fit 
+    to the truncated window of available samples.
+
+    x:      Data to be smoothed, 1-D (samples) or 2-D (samples x columns)
+    N:      Number of samples in the window (odd)
+    order:  Order of the fitted polynomial
+    """
+
+    if N%2 == 0:
+        raise ValueError('Savitzky-Golay window (N) must be odd')
+    if order >= N:
+        raise ValueError('Polynomial order must be less than the window size')
+
+    x    = np.asarray(x, dtype='float')
+    n    = x.shape[0]
+    half = (N-1)//2
+
+    # Weights that evaluate a polynomial fit to samples t at position t0
+    def fit_weights(t, t0, c_order):
+        V = np.vander(t - t0, c_order+1, increasing=True)
+        return np.linalg.pinv(V)[0]
+
+    # Interior via convolution with the central weights (NaNs stay within their windows)
+    out = np.full(x.shape, np.nan)
+    if n >= N:
+        w   = fit_weights(np.arange(-half, half+1), 0, order)
+        x2  = x.reshape(n, -1)
+        mid = np.column_stack([np.convolve(x2[:,i], w[::-1], mode='valid') 
+                               for i in range(x2.shape[1])])
+        out[half:n-half] = mid.reshape((n-2*half,) + x.shape[1:])
+
+    # Ends via fits to the truncated windows
+    for i in np.concatenate([np.arange(min(half,n)), np.arange(max(n-half,half), n)]):
+        a = max(0, i-half)
+        b = min(n, i+half+1)
+        w = fit_weights(np.arange(a,b), i, min(order, b-a-1))
+        out[i] = np.tensordot(w, x[a:b], axes=1)
+
+    return out
+
+
+def conv_smooth(x, kernel):
+    """ Smooths along the first axis by convolution with a centered kernel (odd length). 
+    Near the ends, the kernel is renormalized to the available samples.
+
+    x:      Data to be smoothed, 1-D (samples) or 2-D (samples x columns)
+    kernel: Weights of the smoothing kernel
+    """
+
+    x      = np.asarray(x, dtype='float')
+    kernel = np.asarray(kernel, dtype='float')
+    n      = x.shape[0]
+
+    if len(kernel)%2 == 0:
+        raise ValueError('Kernel must have an odd number of values')
+
+    # Work on columns
+    x2     = x.reshape(n, -1)
+    is_nan = np.isnan(x2)
+    vals   = np.where(is_nan, 0, x2)
+
+    # Centered convolution, which keeps n samples even when the kernel is longer than the data
+    half = len(kernel) // 2
+    def conv(v, k):
+        return np.convolve(v, k, mode='full')[half:half+n]
+
+    # Sum of weights that fall within the data at each sample
+    w_sum = conv(np.ones(n), kernel)
+
+    out = np.empty(x2.shape)
+    for i in range(x2.shape[1]):
+        out[:,i] = conv(vals[:,i], kernel) / w_sum
+
+        # NaN wherever the kernel reaches a NaN
+        if np.any(is_nan[:,i]):
+            hit = conv(is_nan[:,i], np.ones(len(kernel))) > 0
+            out[hit,i] = np.nan
+
+    return out.reshape(x.shape)
+
+
+def circ_smooth(ang, method='boxcar', **kwargs):
+    """ Smooths angular data (in radians, e.g. headings) along the first axis, 
+    by smoothing the sine and cosine components.
+
+    ang:    Angles to be smoothed, 1-D (samples) or 2-D (samples x columns)
+    method: Smoothing method: 'boxcar', 'gauss' or 'savgol'
+    kwargs: Parameters passed to the smoothing function (e.g., N, sigma, order)
+    """
+
+    smooth_funcs = {'boxcar': running_mean, 
+                    'gauss':  gauss_smooth, 
+                    'savgol': savgol_smooth}
+
+    if method not in smooth_funcs:
+        raise ValueError('Smoothing method not recognized: ' + str(method))
+
+    ang = np.asarray(ang, dtype='float')
+
+    # Smooth both components in one call
+    sc = smooth_funcs[method](np.stack([np.sin(ang), np.cos(ang)], axis=-1), **kwargs)
+
+    return np.arctan2(sc[...,0], sc[...,1])
+
+
+def plt_all_traj(refine_coord_path, cat_path, f_suffix='*derived.pkl.xz', save_path=None, workers=1, 
+                 max_pts=None):
     """ Steps through sequences to plot all trajectories
     
     refine_coord_path:      Path to refined coordinate data
     cat_path:               Path to video catalog file
     f_suffix:               Suffix for derived data files
     save_path:              Directory path for saving files
+    workers:                Number of processes for rendering figures headless (Agg) in parallel (requires save_path)
+    max_pts:                Max number of points drawn per trajectory, decimated with lttb (all points, if None)
     """
 
     import matplotlib.pyplot as plt 
 
     # Enhance resolution
-    plt.rcParams['figure.dpi'] = 300
-    plt.rcParams['savefig.dpi'] = 300
+    dpi = 300
+    plt.rcParams['figure.dpi'] = dpi
+    plt.rcParams['savefig.dpi'] = dpi
 
     # Buffer for ticks
     t_buff = 0.05
@@ -496,120 +837,214 @@ def plt_all_traj(refine_coord_path, cat_path, f_suffix='*derived.pkl.xz', save_p
     else:
         raise ValueError('path not recognized')
 
-    # List of figures to make
-    num_figs = int(np.ceil(len(d_files)/(num_cols*num_rows)))
+    # Get the range of values among all data from the manifest (for setting plot axes and ticks)
+    man = get_manifest(refine_coord_path, d_files, cat_path)
+    min_x     = man.x_min.to_numpy(dtype=float)
+    min_y     = man.y_min.to_numpy(dtype=float)
+    max_x     = man.x_max.to_numpy(dtype=float)
+    max_y     = man.y_max.to_numpy(dtype=float)
+    ang_deg   = man.angle_deg.to_numpy(dtype=float).astype(int)
+
+    # Index for order of figures, in order of angle of slopes
+    loc_fig = np.argsort(ang_deg)
+
+    # Range along x and y
+    rng_y   = max_y-min_y
+    rng_x   = max_x-min_x
 
-    # plot indicies
-    # fi_num = 1
-    row_num = 0
-    col_num = 0
+    # Largest range
+    rng = np.max([np.max(rng_y),np.max(rng_x)])*(1+2*t_buff)
 
-    # Initialize range of values
-    min_x     = np.array([],dtype=float)
-    min_y     = np.array([],dtype=float)
-    max_x     = np.array([],dtype=float)
-    max_y     = np.array([],dtype=float)
-    ang_deg   = np.array([],dtype=int)
+    # Sequences (file, title) and output file of each figure
+    fig_tasks = fig_sequences(d_files, loc_fig, ang_deg, num_rows*num_cols, save_path, 'trajplot_')
 
-    # Get the range of values among all data (for setting plot axes and ticks)
-    for c_file in d_files:
+    # Make figures
+    render_figs(traj_fig, fig_tasks, workers, rng=rng, t_buff=t_buff, num_rows=num_rows, 
+                num_cols=num_cols, max_pts=max_pts, dpi=dpi)
 
-        # Read dataframe
-        df = pd.read_pickle(c_file)
 
-        # Add min/max values
-        min_x = np.append(min_x,np.min(df.x_cntr_pix))
-        min_y = np.append(min_y,np.min(df.y_cntr_pix))
-        max_x = np.append(max_x,np.max(df.x_cntr_pix))
-        max_y = np.append(max_y,np.max(df.y_cntr_pix))
+def traj_fig(seqs, save_file=None, rng=None, t_buff=0.05, num_rows=3, num_cols=3, max_pts=None, dpi=300):
+    """ Makes a single figure of trajectories for plt_all_traj and returns it
 
-        # Sequence information to extract from catalog
-        ex_date   = ph.basename(c_file)[:10]
-        ex_seq    = ph.basename(c_file)[11:13]
-        col_name  = 'angle_deg'
+    seqs:       List of (path, title) of the derived data files to be plotted
+    save_file:  Path for saving the figure (not saved, if None)
+    rng:        Range of the axes (pixels)
+    t_buff:     Buffer for ticks, as a proportion of rng
+    num_rows:   Number of rows of subplots
+    num_cols:   Number of columns of subplots
+    max_pts:    Max number of points drawn per trajectory (all points, if None)
+    dpi:        Resolution of the figure
+    """
 
-        # Extract angle for current sequence
-        ang_deg = np.append(ang_deg,int(get_cat_value(cat_path, ex_date, ex_seq, 
-                    col_name  = 'angle_deg')))
+    import matplotlib.pyplot as plt 
 
-    # Index for order of figures, in order of angle of slopes
-    loc_fig = np.argsort(ang_deg)
+    # Create figure
+    fig, axs = plt.subplots(num_rows, num_cols, dpi=dpi)
+    fig.set_size_inches(12,12)
 
-    # Range along x and y
-    rng_y   = max_y-min_y
-    rng_x   = max_x-min_x
+    # Index of current plot
+    n_plt = 0
 
-    # Find overall range values
-    min_x   = np.min(min_x)
-    max_x   = np.max(max_x)
-    # mean_x  = np.mean([min_x,max_x])
-    min_y   = np.min(min_y)
-    max_y   = np.max(max_y)
+    # Loop thru rows
+    for row_num in range(num_rows):
+        # Loop thru columns of subplots
+        for col_num in range(num_cols):
 
-    # Largest range
-    rng = np.max([np.max(rng_y),np.max(rng_x)])*(1+2*t_buff)
+            if n_plt<len(seqs):
+                
+                # Current file and sequence name
+                c_file, seq_name = seqs[n_plt]
 
-    # Index of current file, plot number
-    n_plt     = 0
-    breakAll  = False
-
-    # Loop thru figures
-    for c_fig in range(num_figs):
-
-        # Create figure
-        fig, axs = plt.subplots(num_rows, num_cols)
-        fig.set_size_inches(12,12)
-        # fig.set_facecolor='w'
-
-        # Loop thru rows
-        for row_num in range(num_rows):
-            # Loop thru columns of subplots
-            for col_num in range(num_cols):
-
-                if n_plt<len(d_files)-1:
-                    
-                    # Current file
-                    c_file = d_files[loc_fig[n_plt]]
-
-                    # Load dataframe from current path
-                    df = pd.read_pickle(c_file)
-
-                    # Sequence name
-                    seq_name = str(ang_deg[loc_fig[n_plt]])+' deg '+ph.basename(c_file)[0:13]
-
-                    # Adjust range of axes
-                    mean_x = np.mean(df.x_cntr_pix)
-                    x_tick = [mean_x-rng/2, mean_x+rng/2]
-                    y_tick = [np.min(df.y_cntr_pix)-(rng*t_buff), 
-                              np.min(df.y_cntr_pix)+rng-(rng*t_buff)]
-
-                    # Plot data
-                    axs[row_num,col_num].plot(df.x_cntr_pix,df.y_cntr_pix)
-                    axs[row_num,col_num].plot(df.x_cntr_pix[0],df.y_cntr_pix[0],'o',color='blue')                    
-                    
-                # Empty plot, if no data
-                else:
-                    axs[row_num,col_num].plot([],[])
+                # Load dataframe from current path
+                df = ds.load_data(c_file, columns=['x_cntr_pix','y_cntr_pix'])
+                x  = df.x_cntr_pix.to_numpy()
+                y  = df.y_cntr_pix.to_numpy()
+
+                # Adjust range of axes
+                mean_x = np.mean(x)
+                x_tick = [mean_x-rng/2, mean_x+rng/2]
+                y_tick = [np.min(y)-(rng*t_buff), 
+                          np.min(y)+rng-(rng*t_buff)]
+
+                # Plot data
+                i_pts = lttb(x, y, max_pts)
+                axs[row_num,col_num].plot(x[i_pts],y[i_pts])
+                axs[row_num,col_num].plot(x[0],y[0],'o',color='blue')                    
                 
-                axs[row_num,col_num].set_title(seq_name,fontsize=16,color='k')
-                axs[row_num,col_num].set_aspect('equal')
-                axs[row_num,col_num].set_xlim(x_tick)
-                axs[row_num,col_num].set_ylim(y_tick)
-                axs[row_num,col_num].set_xticks(x_tick)
-                axs[row_num,col_num].set_yticks(y_tick)
-                axs[row_num,col_num].tick_params(axis='both', which='both', right=False, left=False, top=False, bottom=False,labelbottom=False, labelleft=False)
-
-                # Advance plot 
-                seq_name = ' '
-                n_plt = n_plt + 1
-
-            if breakAll:
-                break
-
-        if not (save_path is None):
-            save_file = save_path+ph.sep+'trajplot_'+str(c_fig)+'.jpg'
-            fig.savefig(save_file, bbox_inches='tight')
-    # fig.show()
+            # Empty plot, if no data
+            else:
+                axs[row_num,col_num].plot([],[])
+            
+            axs[row_num,col_num].set_title(seq_name,fontsize=16,color='k')
+            axs[row_num,col_num].set_aspect('equal')
+            axs[row_num,col_num].set_xlim(x_tick)
+            axs[row_num,col_num].set_ylim(y_tick)
+            axs[row_num,col_num].set_xticks(x_tick)
+            axs[row_num,col_num].set_yticks(y_tick)
+            axs[row_num,col_num].tick_params(axis='both', which='both', right=False, left=False, top=False, bottom=False,labelbottom=False, labelleft=False)
+
+            # Advance plot 
+            seq_name = ' '
+            n_plt = n_plt + 1
+
+    if not (save_file is None):
+        fig.savefig(save_file, bbox_inches='tight', dpi=dpi)
+
+    return fig
+
+
+def fig_sequences(d_files, loc_fig, ang_deg, num_plts, save_path, f_prefix):
+    """ Splits sequences among figures, returning a list of (seqs, save_file) for each figure.
+
+    d_files:    List of derived data files
+    loc_fig:    Order of the files in the figures
+    ang_deg:    Angle of each sequence, for the titles
+    num_plts:   Number of subplots per figure
+    save_path:  Directory path for saving files (None, if not saved)
+    f_prefix:   Start of the filename of each figure
+    """
+
+    fig_tasks = []
+    for c_fig in range(int(np.ceil(len(d_files)/num_plts))):
+
+        # Files and titles of the sequences in the current figure
+        c_locs = loc_fig[c_fig*num_plts:(c_fig+1)*num_plts]
+        seqs   = [(d_files[i], str(ang_deg[i]) + ' deg ' + ph.basename(d_files[i])[0:13]) 
+                  for i in c_locs]
+
+        if save_path is None:
+            save_file = None
+        else:
+            save_file = save_path+ph.sep+f_prefix+str(c_fig)+'.jpg'
+
+        fig_tasks.append((seqs, save_file))
+
+    return fig_tasks
+
+
+def render_figs(fig_func, fig_tasks, workers=1, **kwargs):
+    """ Makes figures with fig_func(seqs, save_file, **kwargs) for each (seqs, save_file) in fig_tasks.
+    With more than one worker, figures are rendered headless (Agg backend) over a pool of processes,
+    one figure per task, and closed once saved.
+
+    fig_func:   Function that makes a single figure
+    fig_tasks:  List of (seqs, save_file) for each figure
+    workers:    Number of processes (1 makes the figures in series, in the current backend)
+    kwargs:     Arguments passed to fig_func
+    """
+
+    if workers is None or workers>1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        if any(save_file is None for _, save_file in fig_tasks):
+            raise ValueError('save_path is needed for rendering figures in parallel')
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=use_agg) as pool:
+            futures = [pool.submit(render_fig_task, fig_func, seqs, save_file, kwargs) 
+                       for seqs, save_file in fig_tasks]
+            for c_future in futures:
+                print('   Figure saved to disk: ' + c_future.result())
+    else:
+        for seqs, save_file in fig_tasks:
+            fig_func(seqs, save_file, **kwargs)
+
+
+def use_agg():
+    """ Sets the headless (Agg) backend of matplotlib, for rendering in worker processes """
+
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def render_fig_task(fig_func, seqs, save_file, kwargs):
+    """ Makes and saves a single figure, then closes it. Returns the path of the saved figure. """
+
+    import matplotlib.pyplot as plt 
+
+    use_agg()
+    fig = fig_func(seqs, save_file, **kwargs)
+    plt.close(fig)
+
+    return save_file
+
+
+def lttb(x, y, n_out=None):
+    """ Largest-triangle-three-buckets decimation of an ordered series of points.
+    Returns the indices of the points kept, which preserve the shape of the line when drawn.
+
+    x,y:    Coordinates of the points, in drawing order
+    n_out:  Number of points to keep (all points, if None or not fewer than the number of points)
+    """
+
+    n = len(x)
+    if (n_out is None) or (n_out >= n) or (n_out < 3):
+        return np.arange(n)
+
+    x = np.asarray(x, dtype='float')
+    y = np.asarray(y, dtype='float')
+
+    # Bucket edges (first and last points are kept as their own buckets)
+    edges = np.floor(np.arange(n_out-1)*(n-2)/(n_out-2)).astype(int) + 1
+    edges[-1] = n-1
+
+    i_keep    = np.zeros(n_out, dtype='int')
+    i_keep[-1] = n-1
+    a = 0
+    for i in range(n_out-2):
+
+        # Average of the next bucket
+        s, e = edges[i+1], (edges[i+2] if i+2 < len(edges) else n)
+        avg_x = np.mean(x[s:e])
+        avg_y = np.mean(y[s:e])
+
+        # Point in the current bucket forming the largest triangle with the last point kept
+        r0, r1 = edges[i], edges[i+1]
+        area = np.abs((x[a]-avg_x)*(y[r0:r1]-y[a]) - (x[a]-x[r0:r1])*(avg_y-y[a]))
+        a = r0 + np.argmax(np.nan_to_num(area, nan=-1))
+        i_keep[i+1] = a
+
+    return i_keep
+
 
 def get_cat_value(cat_path,ex_date,ex_seq,col_name):
     """ Return the value from the catalog data for the requested experiments and column name.
@@ -620,40 +1055,27 @@ def get_cat_value(cat_path,ex_date,ex_seq,col_name):
     col_name:   Name of column in video catalog to be extracted
     """
 
-    # Load video catalog
-    cat = pd.read_csv(cat_path)
-
-    # Define rows of catalog that have useful data
-    loc_data = np.arange(np.where(pd.isna(cat.date))[0][0])
-
-    # find location (row) of the catalog that matches the data filename
-    trials = cat.trial_num[loc_data]
-    dates  = cat.date[loc_data]
-    i_cat_seq = (dates==ex_date) & (trials.astype('int')==int(ex_seq))
-    loc_cat = np.where(i_cat_seq)[0]
+    return get_catalog(cat_path).get_value(ex_date, ex_seq, col_name)
 
-    cat_value = eval('cat.'+col_name+'[loc_cat]')
 
-    return cat_value
-
-
-def plt_all_timeseries(refine_coord_path, cat_path, f_suffix='*derived.pkl.xz', save_path=None):
+def plt_all_timeseries(refine_coord_path, cat_path, f_suffix='*derived.pkl.xz', save_path=None, workers=1, 
+                       max_pts=None):
     """ Steps through sequences to plot all trajectories
     
     refine_coord_path:      Path to refined coordinate data
     cat_path:               Path to video catalog file
     f_suffix:               Suffix for derived data files
     save_path:              Directory path for saving files
+    workers:                Number of processes for rendering figures headless (Agg) in parallel (requires save_path)
+    max_pts:                Max number of points drawn per time series, decimated with lttb (all points, if None)
     """
 
     import matplotlib.pyplot as plt 
 
     # Enhance resolution
-    plt.rcParams['figure.dpi'] = 500
-    plt.rcParams['savefig.dpi'] = 500
-
-    # Buffer for ticks
-    t_buff = 0.05
+    dpi = 500
+    plt.rcParams['figure.dpi'] = dpi
+    plt.rcParams['savefig.dpi'] = dpi
 
     # Number of rows per figure
     num_rows = 5
@@ -664,129 +1086,93 @@ def plt_all_timeseries(refine_coord_path, cat_path, f_suffix='*derived.pkl.xz',
     else:
         raise ValueError('path not recognized')
 
-    # List of figures to make
-    num_figs = int(np.ceil(len(d_files)/(num_rows)))
-
-    # plot indicies
-    # fi_num = 1
-    row_num = 0
-
-    # Initialize range of values
-    min_t     = np.array([],dtype=float)
-    max_t     = np.array([],dtype=float)
-    min_spd   = np.array([],dtype=float)
-    max_spd   = np.array([],dtype=float)
-    min_head  = np.array([],dtype=float)
-    max_head  = np.array([],dtype=float)
-    ang_deg   = np.array([],dtype=int)
-
-    # Get the range of values among all data (for setting plot axes and ticks)
-    for c_file in d_files:
-
-        # Read dataframe
-        df = pd.read_pickle(c_file)
-
-        # Add min/max values
-        min_t     = np.append(min_t,    np.min(df.time_s))
-        max_t     = np.append(max_t,    np.max(df.time_s))
-        min_spd   = np.append(min_spd,  np.min(df.spd_pixs))
-        max_spd   = np.append(max_spd,  np.max(df.spd_pixs))
-        min_head  = np.append(min_head, np.min(df.head_rad))
-        max_head  = np.append(max_head, np.max(df.head_rad))
-
-        # Sequence information to extract from catalog
-        ex_date   = ph.basename(c_file)[:10]
-        ex_seq    = ph.basename(c_file)[11:13]
-        col_name  = 'angle_deg'
-
-        # Extract angle for current sequence
-        ang_deg = np.append(ang_deg,int(get_cat_value(cat_path, ex_date,    
-                    ex_seq, col_name  = 'angle_deg')))
+    # Get the range of values among all data from the manifest (for setting plot axes and ticks)
+    man = get_manifest(refine_coord_path, d_files, cat_path)
+    min_t     = man.t_min.to_numpy(dtype=float)
+    max_t     = man.t_max.to_numpy(dtype=float)
+    min_spd   = man.spd_min.to_numpy(dtype=float)
+    max_spd   = man.spd_max.to_numpy(dtype=float)
+    ang_deg   = man.angle_deg.to_numpy(dtype=float).astype(int)
 
     # Index for order of figures, in order of angle of slopes
     loc_fig = np.argsort(ang_deg)
 
-    # Range along x and y
-    rng_head = max_head-min_head
-    rng_spd  = max_spd-min_spd
-    rng_x    = max_t-min_t
-
     # Find overall range values
     min_t     = np.min(min_t)
     max_t     = np.max(max_t)
     min_spd   = np.min(min_spd)
     max_spd   = np.max(max_spd)
-    min_head  = np.min(min_head)
-    max_head  = np.max(max_head)
-
-    # Largest range
-    # rng = np.max([np.max(rng_y),np.max(rng_x)])*(1+2*t_buff)
 
-    # Index of current file, plot number
-    n_plt     = 0
-    breakAll  = False
+    # Sequences (file, title) and output file of each figure
+    fig_tasks = fig_sequences(d_files, loc_fig, ang_deg, num_rows, save_path, 'timeseries_')
 
-    # Loop thru figures
-    for c_fig in range(num_figs):
+    # Make figures
+    render_figs(timeseries_fig, fig_tasks, workers, t_lim=[min_t, max_t], spd_lim=[min_spd, max_spd],
+                num_rows=num_rows, max_pts=max_pts, dpi=dpi)
 
-        # Create figure
-        fig, axs = plt.subplots(num_rows, 1)
-        fig.set_size_inches(8,24)
 
-        # Loop thru rows
-        for row_num in range(num_rows):
+def timeseries_fig(seqs, save_file=None, t_lim=None, spd_lim=None, num_rows=5, max_pts=None, dpi=500):
+    """ Makes a single figure of speed and heading time series for plt_all_timeseries and returns it
 
-            # If we are within limits of current plot
-            if n_plt<len(d_files)-1:
-                
-                # Current file
-                c_file = d_files[loc_fig[n_plt]]
-
-                # Load dataframe from current path
-                df = pd.read_pickle(c_file)
+    seqs:       List of (path, title) of the derived data files to be plotted
+    save_file:  Path for saving the figure (not saved, if None)
+    t_lim:      Min and max time for the x-axis
+    spd_lim:    Min and max speed for the y-axis
+    num_rows:   Number of rows of subplots
+    max_pts:    Max number of points drawn per time series (all points, if None)
+    dpi:        Resolution of the figure
+    """
 
-                # Sequence name
-                seq_name = str(ang_deg[loc_fig[n_plt]]) + ' deg ' + ph.basename(c_file)[0:13]
+    import matplotlib.pyplot as plt 
 
+    # Create figure
+    fig, axs = plt.subplots(num_rows, 1, dpi=dpi)
+    fig.set_size_inches(8,24)
 
-                # Plot data
-                axs[row_num].plot(df.time_s,df.spd_pixs,color='b')
-                axs[row_num].set_ylabel('Spd (pix/s)')
+    # Loop thru rows
+    for row_num in range(num_rows):
 
-                head_deg = np.unwrap(df.head_rad)*180/np.pi
-                ax_sub = axs[row_num].twinx()
-                ax_sub.plot(df.time_s,head_deg,color='r')
-                ax_sub.set_ylabel('heading')
-                
-                # Adjust range of axes
-                x_tick  = np.linspace(min_t,max_t,5)
-                y_tick1 = np.linspace(min_spd,max_spd,3)
-                y_tick2 = np.linspace(np.min(head_deg),np.max(head_deg),3)
-
-                ttt=3
-                # axs[row_num,col_num].axis('equal')
-                
-                # axs[row_num,col_num].grid(axis='x', color='0.75')
-                # axs[row_num,col_num].grid(axis='y', color='0.75')
-                
-            else:
-                axs[row_num].plot([],[])
+        # If we are within limits of current plot
+        if row_num<len(seqs):
+            
+            # Current file and sequence name
+            c_file, seq_name = seqs[row_num]
+
+            # Load dataframe from current path
+            df = ds.load_data(c_file, columns=['time_s','spd_pixs','head_rad'])
+            t        = df.time_s.to_numpy()
+            spd      = df.spd_pixs.to_numpy()
+            head_deg = np.unwrap(df.head_rad)*180/np.pi
+
+            # Plot data
+            i_pts = lttb(t, spd, max_pts)
+            axs[row_num].plot(t[i_pts],spd[i_pts],color='b')
+            axs[row_num].set_ylabel('Spd (pix/s)')
+
+            i_pts = lttb(t, head_deg, max_pts)
+            ax_sub = axs[row_num].twinx()
+            ax_sub.plot(t[i_pts],head_deg[i_pts],color='r')
+            ax_sub.set_ylabel('heading')
+            
+            # Adjust range of axes
+            x_tick  = np.linspace(t_lim[0],t_lim[1],5)
+            y_tick1 = np.linspace(spd_lim[0],spd_lim[1],3)
+            y_tick2 = np.linspace(np.min(head_deg),np.max(head_deg),3)
             
-            axs[row_num].set_title(seq_name,fontsize=16,color='k')
-            axs[row_num].set_xlim([np.min(x_tick), np.max(x_tick)])
-            axs[row_num].set_xticks(x_tick)
-            axs[row_num].set_ylim([np.min(y_tick1),np.max(y_tick1)])
-            axs[row_num].set_yticks(y_tick1)
-            ax_sub.set_ylim([np.min(y_tick2), np.max(y_tick2)])
-            ax_sub.set_yticks(y_tick2)
-            # axs[row_num].tick_params(axis='both', which='both', right=False, left=False, top=False, bottom=False,labelbottom=False, labelleft=False)
+        else:
+            axs[row_num].plot([],[])
+        
+        axs[row_num].set_title(seq_name,fontsize=16,color='k')
+        axs[row_num].set_xlim([np.min(x_tick), np.max(x_tick)])
+        axs[row_num].set_xticks(x_tick)
+        axs[row_num].set_ylim([np.min(y_tick1),np.max(y_tick1)])
+        axs[row_num].set_yticks(y_tick1)
+        ax_sub.set_ylim([np.min(y_tick2), np.max(y_tick2)])
+        ax_sub.set_yticks(y_tick2)
 
-            seq_name = ' '
-            n_plt = n_plt + 1
+        seq_name = ' '
 
-            if not (save_path is None):
-                save_file = save_path+ph.sep+'timeseries_'+str(c_fig)+'.jpg'
-                fig.savefig(save_file, bbox_inches='tight')
+    if not (save_file is None):
+        fig.savefig(save_file, bbox_inches='tight', dpi=dpi)
 
-        if breakAll:
-            break
\ No newline at end of file
+    return fig
@@ -152,57 +152,21 @@ def batch_command(cmds):
 # Extract experiment catalog info
 cat = af.get_cat_info(path['cat'])
 
-# Make the masked videos (stored in 'tmp' directory)
+# Make the masked and cropped videos in a single pass (stored in 'vidout' directory)
 print(' ')
 print('=====================================================')
-print('First, creating masked videos . . .')
-cmds = af.convert_masked_videos(cat, in_path=path['vidin'], out_path=path['tmp'], maskpath=path['mask'], vmode=False, 
-                         imquality=1, para_mode=False, echo=True)
+print('Creating masked and cropped videos . . .')
+cmds = af.convert_videos(cat, in_path=path['vidin'], out_path=path['vidout'], maskpath=path['mask'], vmode=False, 
+                         imquality=0.75, suffix_in=vid_ext_raw, para_mode=False, echo=True)
 
-# Run FFMPEG commands in parallel
-# batch_command(cmds)
+# Run FFMPEG commands in parallel (with para_mode=True)
+# af.run_commands(cmds, n_jobs=num_cores)
 
-# [r.result() for r in res]
-
-
-# %%
-# Make the downsampled/cropped videos  (stored in 'pilot_compressed' directory)
-print(' ')
-print('=====================================================')
-print('Second, creating downsampled and cropped videos . . .')
-af.convert_videos(cat, in_path=path['tmp'], out_path=path['vidout'], vmode=False, imquality=0.75, vertpix=720, suffix_in='mp4')
-
-# Survey resulting directories 
-# Loop thru each video listed in cat
+# Survey resulting directories (compares frame counts of source and output movies)
 print(' ')
 print('=====================================================')
 print('Surveying results . . .')
-for c_row in cat.index:
-    # Input video path
-    vid_in_path = path['vidin'] + os.sep + cat.video_filename[c_row] + '.' + os.sep + vid_ext_raw
-
-    # Temp video path
-    vid_tmp_path = path['tmp'] + os.sep + cat.video_filename[c_row] + '.mp4'
-
-    # Output video path
-    vid_out_path = path['vidout'] + os.sep + cat.video_filename[c_row] + '.mp4'
-
-    # Check that output file was made
-    if not os.path.isfile(vid_out_path):
-
-        print('   Output movie NOT created successfully: ' + vid_out_path)
-
-        if os.path.isfile(vid_tmp_path):
-            print('   Also, temp. movie NOT created successfully: ' + vid_tmp_path)
-        else:
-            print('   But, temp. movie created successfully: ' + vid_tmp_path)
-    else:
-
-        print('   Output movie created successfully: ' + vid_out_path)
-
-        # Delete temp file
-        if os.path.isfile(vid_tmp_path):
-            os.remove(vid_tmp_path)
+survey = af.survey_videos(cat, in_path=path['vidin'], out_path=path['vidout'], suffix_in=vid_ext_raw)
 
 
 #%%
@@ -210,15 +174,8 @@ for c_row in cat.index:
 -----------------------------------------------------------------------------------------------------
 """
 
-# # import videotools as vt
-# import cv2 as cv  # openCV for interacting with video
-# import numpy as np
-# import pandas as pd
-
-import def_acquisition as da
-
-# Batch run to analyze pixel intensity of all videos in cat
-da.measure_pixintensity(cat, path['data'], path['vidout'])
+# Batch run to measure pixel intensity (and motion) of all videos in cat, at quarter resolution
+stats = af.measure_frame_stats(cat, path['vidout'], path['data'], scale=0.25, workers=num_cores)
 
 
 #%%
@@ -226,26 +183,15 @@ da.measure_pixintensity(cat, path['data'], path['vidout'])
 -----------------------------------------------------------------------------------------------------
 """
 
-import pandas as pd
-import glob
 import plotly.express as px
-
-
-# path = os.getcwd()
-csv_files = glob.glob(os.path.join(path['data'], "*.pixelintensity"))
+import datastore as ds
 
 # Loop thru each video listed in cat
 for c_row in cat.index:
 
-    # Unique identifier for the current sequence
-    exp_name = cat.date[c_row] + '_' + format(cat.exp_num[c_row],'03')
-
-    # Path for output data for current sequence
-    din_path = path['data'] + os.path.sep + exp_name + '_pixelintensity'
-
-    # Read dataframe and plot pixel intensity
-    df = pd.read_pickle(din_path)
-    fig = px.line(df,x="time_s", y="meanpixval", title=exp_name)
+    # Read table and plot pixel intensity
+    df = ds.load_data(stats.data_path[c_row], columns=['time_s', 'mean'])
+    fig = px.line(df, x="time_s", y="mean", title=cat.video_filename[c_row])
     fig.show()
 
 
@@ -0,0 +1,341 @@
+""" Index of video metadata, shared by videotools and acqfunctions.
+Each video is probed once with ffprobe and its metadata (frame size, frame rate, codec, pixel format and 
+duration) are kept in a local SQLite file. Reading the stream headers is quick, so that is all a first probe does.
+The packets of a video (presentation time, keyframe flag and byte offset, for the exact frame count, the keyframe
+structure and frame-accurate random access) are scanned from the whole file, only when they are first needed.
+Entries are keyed by path, file size and modification time, so a video is probed again only when it changes.
+"""
+
+import os
+import json
+import sqlite3
+import subprocess
+import numpy as np
+import pandas as pd
+
+
+# Default location of the index file (can be set with the KINEKIT_VIDEO_INDEX environment variable)
+DEFAULT_INDEX_PATH = os.path.join(os.path.expanduser('~'), '.kinekit', 'video_index.sqlite')
+
+# Columns of the index table, with their SQL types (the last six are filled once the packets are scanned)
+INDEX_COLUMNS = {
+    'path':         'TEXT PRIMARY KEY',
+    'size':         'INTEGER',
+    'mtime':        'REAL',
+    'width':        'INTEGER',
+    'height':       'INTEGER',
+    'fps':          'REAL',
+    'nb_frames':    'INTEGER',
+    'codec':        'TEXT',
+    'pix_fmt':      'TEXT',
+    'duration':     'REAL',
+    'frame_count':  'INTEGER',
+    'n_keyframes':  'INTEGER',
+    'gop_max':      'INTEGER',
+    'gop_mean':     'REAL',
+    'key_frames':   'TEXT',
+    'key_times':    'TEXT',
+    }
+
+# Columns of the packet table (one row per frame, in presentation order), with their SQL types
+PACKET_COLUMNS = {
+    'path':         'TEXT',
+    'frame':        'INTEGER',
+    'time':         'REAL',
+    'key':          'INTEGER',
+    'pos':          'INTEGER',
+    }
+
+# Indices already opened, keyed by absolute path
+loaded_indices = {}
+
+
+def get_index(index_path=None):
+    """ Returns the video index stored at index_path.
+
+    index_path: Path to SQLite file (defaults to KINEKIT_VIDEO_INDEX, or DEFAULT_INDEX_PATH)
+    """
+
+    if index_path is None:
+        index_path = os.environ.get('KINEKIT_VIDEO_INDEX', DEFAULT_INDEX_PATH)
+
+    key = os.path.abspath(index_path)
+
+    if key not in loaded_indices:
+        loaded_indices[key] = VideoIndex(key)
+
+    return loaded_indices[key]
+
+
+def video_info(vid_path, index_path=None, packets=False):
+    """ Returns the metadata of a video file (dict), probing it only if it is not in the index.
+
+    vid_path:   Full path to the video file
+    index_path: Path to SQLite file of the index (see get_index)
+    packets:    Whether the packet fields (frame_count and keyframe structure) are needed, which scans the packets 
+                of the video if they are not in the index yet. Otherwise, they are None until then.
+    """
+
+    return get_index(index_path).get(vid_path, packets=packets)
+
+
+def video_packets(vid_path, index_path=None):
+    """ Returns the packet table of a video file (see VideoIndex.get_packets).
+
+    vid_path:   Full path to the video file
+    index_path: Path to SQLite file of the index (see get_index)
+    """
+
+    return get_index(index_path).get_packets(vid_path)
+
+
+class VideoIndex:
+    """ Video metadata stored in a SQLite file, with one row per video file.
+
+    index_path: Path to SQLite file (created if needed)
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+
+        # Create the file and table, if needed
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        with self.connect() as con:
+            # An index made with other columns is rebuilt (it only holds metadata that can be probed again)
+            old_columns = [row[1] for row in con.execute('PRAGMA table_info(videos)')]
+            if (len(old_columns)>0) and (old_columns != list(INDEX_COLUMNS)):
+                con.execute('DROP TABLE videos')
+                con.execute('DROP TABLE IF EXISTS packets')
+
+            con.execute('CREATE TABLE IF NOT EXISTS videos (' +
+                        ', '.join([c + ' ' + t for c, t in INDEX_COLUMNS.items()]) + ')')
+            con.execute('CREATE TABLE IF NOT EXISTS packets (' +
+                        ', '.join([c + ' ' + t for c, t in PACKET_COLUMNS.items()]) + ', PRIMARY KEY (path, frame))')
+
+    def connect(self):
+        """ Returns a new connection to the index file """
+
+        return sqlite3.connect(self.index_path, timeout=30)
+
+    def lookup(self, vid_path):
+        """ Returns the stored metadata of a video file, or None if it is missing or out of date """
+
+        vid_path = os.path.abspath(vid_path)
+        stat = os.stat(vid_path)
+
+        with self.connect() as con:
+            con.row_factory = sqlite3.Row
+            row = con.execute('SELECT * FROM videos WHERE path=?', (vid_path,)).fetchone()
+
+        if (row is None) or (row['size'] != stat.st_size) or (row['mtime'] != stat.st_mtime):
+            return None
+
+        return decode_row(dict(row))
+
+    def store(self, info):
+        """ Adds (or replaces) the metadata of a video file """
+
+        row = dict(info)
+        for c in ('key_frames', 'key_times'):
+            row[c] = None if info[c] is None else json.dumps(np.asarray(info[c]).tolist())
+
+        with self.connect() as con:
+            con.execute('INSERT OR REPLACE INTO videos (' + ', '.join(INDEX_COLUMNS) + ') VALUES (' +
+                        ', '.join(['?'] * len(INDEX_COLUMNS)) + ')', [row[c] for c in INDEX_COLUMNS])
+
+            # Replace the packet table of the video (or drop it, until the packets are scanned again)
+            con.execute('DELETE FROM packets WHERE path=?', (info['path'],))
+            if 'packets' in info:
+                pkts = info['packets']
+                con.executemany('INSERT INTO packets (' + ', '.join(PACKET_COLUMNS) + ') VALUES (' +
+                                ', '.join(['?'] * len(PACKET_COLUMNS)) + ')',
+                                zip([info['path']] * len(pkts), pkts.frame.tolist(), pkts.time.tolist(),
+                                    pkts.key.astype(int).tolist(), pkts.pos.tolist()))
+
+    def get(self, vid_path, packets=False):
+        """ Returns the metadata of a video file (dict), probing it only if it is not in the index.
+        The packets are scanned as well if packets is True and they are not in the index yet (see video_info).
+        """
+
+        if not os.path.isfile(vid_path):
+            raise OSError('Video file does not exist: ' + vid_path)
+
+        info = self.lookup(vid_path)
+
+        if (info is None) or (packets and (info['frame_count'] is None)):
+            info = probe_video(vid_path, packets=packets)
+            self.store(info)
+            info.pop('packets', None)
+
+        return info
+
+    def get_packets(self, vid_path):
+        """ Returns the packet table of a video file (dataframe with columns frame, time, key and pos), 
+        scanning the packets only if they are not in the index """
+
+        info = self.get(vid_path, packets=True)
+
+        with self.connect() as con:
+            pkts = pd.read_sql_query('SELECT frame, time, key, pos FROM packets WHERE path=? ORDER BY frame', 
+                                     con, params=(info['path'],))
+
+        # Indexed before packets were stored
+        if len(pkts) != info['frame_count']:
+            info = probe_video(vid_path, packets=True)
+            self.store(info)
+            pkts = info['packets'][['frame', 'time', 'key', 'pos']]
+
+        pkts['key'] = pkts.key.astype('bool')
+
+        return pkts
+
+    def probe_all(self, vid_paths, workers=None, packets=False):
+        """ Adds the videos missing from the index, probing them in parallel, and returns a table of all of them.
+        A video that cannot be probed (e.g., a truncated file) does not stop the others: its row has only its path 
+        and the reason under 'error' (None for the videos that were read).
+
+        vid_paths:  List of paths to video files
+        workers:    Number of videos probed at once (defaults to the number of cores)
+        packets:    Whether to scan the packets as well (see video_info)
+        """
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        # Only probe what is not already current
+        def is_current(info):
+            return (info is not None) and not (packets and (info['frame_count'] is None))
+        missing = [p for p in vid_paths if not is_current(self.lookup(p))]
+
+        def probe(vid_path):
+            try:
+                return probe_video(vid_path, packets=packets), None
+            except Exception as e:
+                return None, str(e)
+
+        # Each probe runs in its own ffprobe process
+        errors = {}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for vid_path, (info, error) in zip(missing, pool.map(probe, missing)):
+                if info is None:
+                    errors[vid_path] = error
+                else:
+                    self.store(info)
+
+        rows = []
+        for vid_path in vid_paths:
+            if vid_path in errors:
+                rows.append({'path': os.path.abspath(vid_path), 'error': errors[vid_path]})
+            else:
+                rows.append(dict(self.lookup(vid_path), error=None))
+
+        return pd.DataFrame(rows, columns=list(INDEX_COLUMNS) + ['error'])
+
+
+def decode_row(row):
+    """ Returns a row of the index table as a metadata dict, with the keyframe lists as arrays """
+
+    if row['key_frames'] is not None:
+        row['key_frames'] = np.array(json.loads(row['key_frames']), dtype='int')
+        row['key_times']  = np.array(json.loads(row['key_times']), dtype='float')
+
+    return row
+
+
+def probe_video(vid_path, packets=False):
+    """ Probes a video file with ffprobe and returns its metadata (dict, see INDEX_COLUMNS).
+    Only the stream and format headers are read, unless packets is True: the packets of the first video stream 
+    are then read as well (without decoding) to count frames and find keyframes, and the packet table 
+    (dataframe, see PACKET_COLUMNS) is returned under 'packets'.
+
+    vid_path:   Full path to the video file
+    packets:    Whether to scan the packets
+    """
+
+    vid_path = os.path.abspath(vid_path)
+    stat = os.stat(vid_path)
+
+    entries = 'stream=codec_name,pix_fmt,width,height,avg_frame_rate,r_frame_rate,duration,nb_frames' \
+              ':format=duration,start_time'
+    if packets:
+        entries += ':packet=pts_time,flags,pos'
+
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-of', 'json', '-show_entries', entries, vid_path]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+    if result.returncode != 0:
+        raise RuntimeError('ffprobe failed on ' + vid_path + ': ' + result.stderr.strip())
+
+    probe = json.loads(result.stdout)
+    if len(probe.get('streams', []))<1:
+        raise ValueError('No video stream found in: ' + vid_path)
+    stream = probe['streams'][0]
+
+    # Frame rate, from the average rate if it is given
+    fps = to_float(stream.get('avg_frame_rate'))
+    if not (fps > 0):
+        fps = to_float(stream.get('r_frame_rate'))
+
+    # Duration of the stream, or else of the file
+    duration = to_float(stream.get('duration'))
+    if np.isnan(duration):
+        duration = to_float(probe.get('format', {}).get('duration'))
+
+    # Frame count from the container header (missing for some formats)
+    nb_frames = to_float(stream.get('nb_frames'))
+
+    info = {'path':         vid_path,
+            'size':         stat.st_size,
+            'mtime':        stat.st_mtime,
+            'width':        int(stream['width']),
+            'height':       int(stream['height']),
+            'fps':          fps,
+            'nb_frames':    int(nb_frames) if nb_frames >= 0 else None,
+            'codec':        stream.get('codec_name'),
+            'pix_fmt':      stream.get('pix_fmt'),
+            'duration':     duration,
+            'frame_count':  None,
+            'n_keyframes':  None,
+            'gop_max':      None,
+            'gop_mean':     None,
+            'key_frames':   None,
+            'key_times':    None}
+
+    if not packets:
+        return info
+
+    # Packets in presentation order, with times from the start of the file (as used for seeking)
+    pkts = probe.get('packets', [])
+    start_time = to_float(probe.get('format', {}).get('start_time'))
+    times = np.array([to_float(p.get('pts_time')) for p in pkts]) - np.nan_to_num(start_time)
+    is_key = np.array(['K' in p.get('flags', '') for p in pkts], dtype='bool')
+    offsets = np.nan_to_num([to_float(p.get('pos')) for p in pkts], nan=-1).astype('int')
+    order = np.argsort(times, kind='stable')
+    times, is_key, offsets = times[order], is_key[order], offsets[order]
+
+    # Keyframe structure
+    key_frames = np.flatnonzero(is_key)
+    gops = np.diff(np.append(key_frames, len(pkts)))
+
+    info.update({'frame_count':  len(pkts),
+                 'n_keyframes':  len(key_frames),
+                 'gop_max':      int(gops.max()) if len(gops)>0 else 0,
+                 'gop_mean':     float(gops.mean()) if len(gops)>0 else np.nan,
+                 'key_frames':   key_frames,
+                 'key_times':    times[key_frames],
+                 'packets':      pd.DataFrame({'frame': np.arange(len(pkts)), 'time': times, 
+                                               'key': is_key, 'pos': offsets})})
+
+    return info
+
+
+def to_float(val):
+    """ Returns an ffprobe value as a float (e.g., '30000/1001' or '12.5'), or nan if it is missing """
+
+    if val in (None, '', 'N/A'):
+        return np.nan
+
+    num, _, den = str(val).partition('/')
+    if den:
+        return float(num)/float(den) if float(den)!=0 else np.nan
+
+    return float(num)
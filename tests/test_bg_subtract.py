@@ -0,0 +1,62 @@
+""" Checks that bg_subtract with roi_first matches the full-frame filtering within the stated tolerance
+(see videotools.bg_subtract_plan). Run with pytest from the repository root.
+"""
+
+import os
+import sys
+import numpy as np
+import cv2 as cv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sources'))
+import videotools as vt
+
+
+# Tolerance of bg_subtract_frame_roi against bg_subtract_frame, within the roi
+MAX_FRAC_DIFF   = 0.01
+MAX_LEVEL_DIFF  = 2
+
+
+def make_frames(width, height, seed=0):
+    """ Returns a synthetic BGR frame and the complement of its grayscale background """
+
+    rng = np.random.default_rng(seed)
+
+    # Smooth background, with a few flat regions
+    bg = cv.GaussianBlur(rng.integers(0, 256, (height, width), dtype='uint8'), (0, 0), 12)
+    bg[height//3:height//2, :] = 140
+
+    # Frame: the background with some dark shapes and sensor noise
+    frame = cv.cvtColor(bg, cv.COLOR_GRAY2BGR)
+    for _ in range(8):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        cv.circle(frame, center, int(rng.integers(5, 40)), (30, 30, 30), -1)
+    frame = cv.add(frame, rng.integers(0, 12, frame.shape, dtype='uint8'))
+
+    return frame, cv.bitwise_not(bg)
+
+
+def roi_diff(frame, bg_inv, roi):
+    """ Returns the fraction of roi pixels that differ between the two paths, and the largest difference """
+
+    full   = vt.bg_subtract_frame(frame, bg_inv, vt.bg_subtract_clahe(), roi)
+    window = vt.bg_subtract_frame_roi(frame, vt.bg_subtract_plan(bg_inv, roi))
+    assert full.shape == window.shape
+
+    diff = np.abs(full.astype('int') - window)
+
+    return (diff > 0).mean(), diff.max()
+
+
+def test_roi_first_tolerance():
+    for width, height in [(700, 500), (640, 480), (1280, 720), (999, 777)]:
+        frame, bg_inv = make_frames(width, height, seed=width)
+
+        rois = [[width - 140, height - 83, 140, 83],
+                [0, 0, width // 3, height // 3],
+                [width // 4, height // 5, width // 2, height // 2],
+                [13, height - 90, 77, 90]]
+
+        for roi in rois:
+            frac, level = roi_diff(frame, bg_inv, roi)
+            assert frac <= MAX_FRAC_DIFF, (width, height, roi, frac)
+            assert level <= MAX_LEVEL_DIFF, (width, height, roi, level)